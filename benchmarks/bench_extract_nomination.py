@@ -0,0 +1,59 @@
+'''
+Time extract_nomination() against a full parse with nomination_from_tree().
+
+Each page of tests/nominations gets a discussion of the given number of
+comments appended, as most promoted nominations have one. Pages the
+extractor leaves to the parser count with the time of both, as they do in
+find_promotion_ready(). Every page the extractor reads has to give the same
+Nomination as the parser.
+
+    python benchmarks/bench_extract_nomination.py [comments] [rounds]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vicparse import extract_nomination, nomination_from_tree
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'nominations')
+COMMENT = '\n:{{s}} Good scope, {{ping|Example}} see [[COM:VIC|the rules]]. --[[User:Example|Example]] 12:00, 4 May 2026 (UTC)'
+
+
+def extract_or_parse(text):
+    nomination = extract_nomination(text)
+    return nomination_from_tree(text) if nomination is None else nomination
+
+
+def timed(function, texts, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        results = [function(text) for text in texts]
+    return time.perf_counter() - started, results
+
+
+def main(comments=30, rounds=20):
+    texts = []
+    for name in sorted(os.listdir(CORPUS)):
+        with open(os.path.join(CORPUS, name)) as infile:
+            texts.append(infile.read() + '\n== Discussion ==' + COMMENT * comments)
+    extracted = sum(extract_nomination(text) is not None for text in texts)
+    fast, fast_results = timed(extract_or_parse, texts, rounds)
+    tree, tree_results = timed(nomination_from_tree, texts, rounds)
+    same = fast_results == tree_results
+    pages = len(texts) * rounds
+    print('{} pages of {:.0f} characters on average, {} of {} read by the extractor'.format(
+        pages, sum(map(len, texts)) / len(texts), extracted, len(texts)))
+    print('extract_nomination with fallback {:.2f}ms a page, nomination_from_tree {:.2f}ms a page ({:.1f}x), same result: {}'.format(
+        fast / pages * 1000, tree / pages * 1000, tree / fast, same))
+    readable = [text for text in texts if extract_nomination(text) is not None]
+    fast, _ = timed(extract_nomination, readable, rounds)
+    tree, _ = timed(nomination_from_tree, readable, rounds)
+    print('on the pages the extractor reads: {:.3f}ms a page against {:.2f}ms ({:.0f}x)'.format(
+        fast / len(readable) / rounds * 1000, tree / len(readable) / rounds * 1000, tree / fast))
+    return same
+
+
+if __name__ == '__main__':
+    sys.exit(not main(*map(int, sys.argv[1:])))
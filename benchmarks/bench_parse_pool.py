@@ -0,0 +1,54 @@
+'''
+Time a ParsePool parsing a few hundred nominations in this process and on worker processes.
+
+The nominations are the pages of tests/nominations with discussions of
+varying length appended, and every pool has to give the same results. The
+times include starting the workers. Every worker imports the main module
+first, so this one imports vicbot2 as the bot's main module does and the
+workers pay for it and for pywikibot like the bot's do. Worker processes
+only pay off with more than one core, so the number of cores is printed
+along with the times.
+
+    python benchmarks/bench_parse_pool.py [nominations] [workers ...]
+'''
+import os
+import sys
+import time
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '2')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vicbot2  # noqa: F401
+from vicparse import ParsePool, nominations_from_trees
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'nominations')
+COMMENT = '\n:{{s}} Good scope, {{ping|Example}} see [[COM:VIC|the rules]]. --[[User:Example|Example]] 12:00, 4 May 2026 (UTC)'
+
+
+def main(nominations=300, *workers):
+    pages = []
+    for name in sorted(os.listdir(CORPUS)):
+        with open(os.path.join(CORPUS, name)) as infile:
+            pages.append(infile.read())
+    texts = [pages[i % len(pages)] + '\n== Discussion ==' + COMMENT * (i % 60) for i in range(nominations)]
+    print('{} nominations, {} characters, {} cores'.format(len(texts), sum(map(len, texts)), os.cpu_count()))
+    expected = None
+    same = True
+    for count in (0,) + (workers or (1, 2, 4)):
+        # A threshold of 0 sends everything to the workers
+        pool = ParsePool(count, threshold=0)
+        started = time.perf_counter()
+        try:
+            results = pool.map(nominations_from_trees, texts)
+        finally:
+            pool.close()
+        elapsed = time.perf_counter() - started
+        expected = expected or results
+        same = same and results == expected
+        print('{:>12} {:.2f}s'.format('{} workers'.format(count) if count else 'in process', elapsed))
+    print('same results: {}'.format(same))
+    return same
+
+
+if __name__ == '__main__':
+    sys.exit(not main(*map(int, sys.argv[1:])))
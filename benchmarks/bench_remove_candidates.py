@@ -0,0 +1,85 @@
+'''
+Time remove_candidates() on candidate lists with thousands of entries.
+
+The per-candidate loop it replaced is timed on the same lists as a
+baseline, and both have to leave the same text behind.
+
+    python benchmarks/bench_remove_candidates.py [entries] [removed]
+'''
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '2')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mwparserfromhell
+from loguru import logger
+
+import vicbot2
+from vicerrors import ErrorCollector
+from vicstats import Recorder
+from vicwiki import LocalWiki
+
+CANDIDATE_LIST, REVIEW_LIST = vicbot2.CANDIDATE_INPUT_PAGES
+
+
+def candidate_pages(entries):
+    '''Candidate lists with entries candidates in sections of 50, and a review list with a tenth as many.'''
+    names = ['Candidate {}.jpg'.format(i) for i in range(entries)]
+    sections = ['===Section {}===\n{{{{VICs\n{}\n}}}}'.format(i, '\n'.join('|' + name for name in names[i:i + 50]))
+                for i in range(0, entries, 50)]
+    reviews = ['{{{{VICs\n|{}\n}}}}'.format(name) for name in names[:entries // 10]]
+    return names, {CANDIDATE_LIST: {'text': '<!-- VICBOT_ON -->\n' + '\n'.join(sections)},
+                   REVIEW_LIST: {'text': '\n'.join(reviews)}}
+
+
+def old_remove_candidates(candidates_to_remove, texts):
+    '''remove_candidates() as it was before the single indexed pass.'''
+    result = {}
+    for page_title, text in texts.items():
+        parsed = mwparserfromhell.parse(text)
+        for candidate in candidates_to_remove:
+            for template in parsed.filter_templates():
+                if not template.name.matches('VICs'):
+                    continue
+                for param in template.params:
+                    if param.value.matches(candidate):
+                        if 'Most valued review candidate list' in page_title:
+                            parsed.remove(template)
+                        else:
+                            template.params.remove(param)
+        result[page_title] = str(parsed)
+    return result
+
+
+def main(entries=3000, removed=300):
+    logger.remove()
+    names, pages = candidate_pages(entries)
+    candidates = random.Random(1).sample(names, removed)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'wiki.json')
+        with open(path, 'w') as outfile:
+            json.dump({'pages': pages}, outfile)
+        recorder = Recorder()
+        vicbot2.wiki = LocalWiki(path, recorder, dry_run=True)
+        vicbot2.errors = ErrorCollector(recorder)
+        edits = vicbot2.PendingEdits()
+        edits.preload(vicbot2.CANDIDATE_INPUT_PAGES)
+        started = time.perf_counter()
+        vicbot2.remove_candidates(candidates, edits)
+        new = time.perf_counter() - started
+    started = time.perf_counter()
+    old = old_remove_candidates(candidates, {title: page['text'] for title, page in pages.items()})
+    baseline = time.perf_counter() - started
+    same = all(edits.get(title) == old[title] for title in old)
+    print('{} entries, {} removed: remove_candidates {:.3f}s, per-candidate loop {:.3f}s ({:.0f}x), same result: {}'.format(
+        entries, removed, new, baseline, baseline / new, same))
+    return same
+
+
+if __name__ == '__main__':
+    sys.exit(not main(*map(int, sys.argv[1:])))
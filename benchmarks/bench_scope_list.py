@@ -0,0 +1,72 @@
+'''
+Time merge_scope_list() on a scope list the size of Commons:Valued images by scope.
+
+The old bot's rebuild-and-sort of the whole list is timed on the same list
+as a baseline, and both have to give the same text.
+
+    python benchmarks/bench_scope_list.py [entries]
+'''
+import os
+import random
+import string
+import sys
+import time
+
+os.environ.setdefault('PYWIKIBOT_NO_USER_CONFIG', '2')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger
+
+import vicbot2
+
+
+def old_merge_scope_list(text, entries):
+    '''The old bot's update of the scope list, with today's SCOPE_LIST_RE.'''
+    new_list = {}
+    for image, scope in entries:
+        scrubbed = vicbot2.scrub_scope(scope)
+        new_list[scrubbed.replace("'", '').upper()] = '*[[:File:{}|{}]]'.format(image, scrubbed)
+    for line in text.split('\n'):
+        match = vicbot2.SCOPE_LIST_RE.search(line)
+        if match:
+            new_list[match.group(2).replace("'", '').upper()] = line
+    sorted_list = '\n'.join(map(new_list.get, sorted(new_list)))
+    list_printed = False
+    new_text = ''
+    for line in text.split('\n'):
+        if not vicbot2.SCOPE_LIST_RE.search(line):
+            new_text += line + '\n'
+        elif not list_printed:
+            list_printed = True
+            new_text += sorted_list + '\n'
+    return new_text.rstrip('\n')
+
+
+def best_of(repeat, function, *args):
+    '''Shortest time of repeat calls, and the result.'''
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - started)
+    return min(times), result
+
+
+def main(entries=45000):
+    logger.remove()
+    rng = random.Random(1)
+    scopes = sorted({''.join(rng.choices(string.ascii_letters + ' ', k=20)).strip() for _ in range(entries)},
+                    key=vicbot2.scope_sort_key)
+    text = 'Intro\n\n' + '\n'.join('*[[:File:F{}.jpg|{}]]'.format(i, scope) for i, scope in enumerate(scopes)) + \
+        '\n\n[[Category:Valued images]]'
+    # A day's promotions, one of them already listed
+    new = [('New{}.jpg'.format(i), "[[Foo|''Zed{}'']]".format(i)) for i in range(5)] + [('Dup.jpg', scopes[10])]
+    merge, merged = best_of(5, vicbot2.merge_scope_list, text, new)
+    baseline, rebuilt = best_of(5, old_merge_scope_list, text, new)
+    print('{} entries: merge_scope_list {:.3f}s, rebuild and sort {:.3f}s (best of 5), same result: {}'.format(
+        len(scopes), merge, baseline, merged == rebuilt))
+    return merged == rebuilt
+
+
+if __name__ == '__main__':
+    sys.exit(not main(*map(int, sys.argv[1:])))
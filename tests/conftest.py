@@ -0,0 +1,43 @@
+import json
+import os
+import sys
+
+# pywikibot must not look for a user-config.py, the tests never talk to a real wiki
+os.environ['PYWIKIBOT_NO_USER_CONFIG'] = '2'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import vicbot2
+from vicerrors import ErrorCollector
+from vicparse import ParsePool
+from vicreplica import LocalReplica
+from vicstats import Recorder
+from vicwiki import LocalWiki
+
+
+@pytest.fixture
+def local_wiki(tmp_path, monkeypatch):
+    '''
+    Set vicbot2 up like main() does, against a LocalWiki holding the given pages.
+
+    Call it with a dict mapping titles to page dicts as described in
+    vicwiki.LocalWiki. Returns the LocalWiki; saves go to its pages.
+    '''
+    opened = []
+
+    def make(pages, dry_run=False):
+        path = tmp_path / 'wiki.json'
+        path.write_text(json.dumps({'pages': pages}))
+        recorder = Recorder()
+        wiki = LocalWiki(str(path), recorder, dry_run=dry_run)
+        monkeypatch.setattr(vicbot2, 'wiki', wiki)
+        monkeypatch.setattr(vicbot2, 'replica', LocalReplica(wiki, recorder))
+        monkeypatch.setattr(vicbot2, 'errors', ErrorCollector(recorder))
+        monkeypatch.setattr(vicbot2, 'parse_pool', ParsePool(0))
+        opened.append(vicbot2.replica)
+        return wiki
+
+    yield make
+    for replica in opened:
+        replica.close()
@@ -0,0 +1,41 @@
+import json
+
+import vicbot2
+from vicfeed import FileFeed
+from vicstate import Journal, StateStore
+
+CHANGE = {'title': 'Commons:Valued image candidates/A.jpg', 'user': 'Alice'}
+
+
+def test_daemon_carries_on_after_a_failed_pass(local_wiki, tmp_path, monkeypatch):
+    wiki = local_wiki({vicbot2.ERROR_PAGE_TITLE: {'text': ''}})
+    feed_path = tmp_path / 'feed.jsonl'
+    # Three polls, the last one empty
+    feed_path.write_text('{}\n\n{}\n\n\n'.format(json.dumps(CHANGE), json.dumps(CHANGE)))
+    history_path = tmp_path / 'history.jsonl'
+    passes = []
+
+    def run_stages(state, status_backend, journal):
+        passes.append(len(passes))
+        if len(passes) == 1:
+            raise RuntimeError('replica went away')
+        return [], []
+
+    def refresh_sample(state_path):
+        raise OSError('disk full')
+    monkeypatch.setattr(vicbot2, 'run_stages', run_stages)
+    monkeypatch.setattr(vicbot2, 'refresh_sample', refresh_sample)
+    monkeypatch.setattr(vicbot2, 'DAEMON_MAX_DELAY', 0)
+    state = StateStore(str(tmp_path / 'state.db'))
+    try:
+        vicbot2.run_daemon(FileFeed(str(feed_path)), state, Journal(None), str(tmp_path / 'state.db'), 'api',
+                           str(history_path), {'mode': 'local-daemon'})
+    finally:
+        state.close()
+    assert passes == [0, 1]
+    error_page = wiki.pages[vicbot2.ERROR_PAGE_TITLE]['text']
+    assert 'unexpected error RuntimeError: replica went away' in error_page
+    history = [json.loads(line) for line in history_path.read_text().splitlines()]
+    assert history[0]['error'] == 'RuntimeError'
+    # The changes of the failed pass were kept for the next one
+    assert history[1]['changes'] == 1 and history[1]['promoted'] == 0
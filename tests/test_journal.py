@@ -0,0 +1,113 @@
+import pytest
+
+import vicbot2
+from test_promotion import CANDIDATE_LIST, pages, text
+from vicstate import Journal, StateStore
+
+EDIT = {'title': 'File:A.jpg', 'text': 'x', 'summary': 's', 'minor': True, 'baserevid': 1, 'create_only': False}
+ENTRY = {'image': 'A.jpg', 'scope': 'Cats', 'subpage': '', 'review': '', 'username': 'Alice'}
+
+
+def test_outstanding_edits(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    journal = Journal(str(path))
+    journal.plan('one', [EDIT, dict(EDIT, title='File:B.jpg')])
+    journal.done('one', 'File:A.jpg', 1)
+    journal.plan('two', [EDIT])
+    journal.finish('two')
+    assert journal.outstanding() == {'one': [dict(EDIT, title='File:B.jpg')]}
+    # A crash can leave a line half written, the next run writes past it
+    with open(path, 'a') as outfile:
+        outfile.write('{"run": "one", "ev')
+    assert journal.outstanding() == {'one': [dict(EDIT, title='File:B.jpg')]}
+    journal.done('one', 'File:B.jpg', 1)
+    assert journal.outstanding() == {'one': []}
+    journal.finish('one')
+    assert path.read_text() == '' and journal.outstanding() == {}
+
+
+def test_unfinished_promotions(tmp_path):
+    journal = Journal(str(tmp_path / 'journal.jsonl'))
+    journal.promoting('crashed', [ENTRY])
+    journal.plan('crashed', [EDIT])
+    journal.promoting('planned', [ENTRY])
+    journal.plan('planned', [EDIT], last=True)
+    journal.promoting('finished', [ENTRY])
+    journal.finish('finished')
+    assert journal.unfinished_promotions() == {'crashed': [ENTRY]}
+    assert Journal(None).unfinished_promotions() == {}
+
+
+def tagged(wiki):
+    '''Have the tagged files transclude {{VI}}, as the substituted VI-add makes them do.'''
+    for title in ('File:A.jpg', 'File:B.jpg'):
+        if 'VI-add' in text(wiki, title):
+            wiki.pages[title]['templates'] = ['Template:VI']
+
+
+def run(wiki, journal, tmp_path):
+    wiki.recorder.reset()
+    state = StateStore(str(tmp_path / 'state.db'))
+    try:
+        return vicbot2.run_stages(state, 'api', journal)
+    finally:
+        state.close()
+
+
+def test_crash_after_tagging_is_finished_by_the_next_run(local_wiki, tmp_path, monkeypatch):
+    wiki = local_wiki(pages(protected=False))
+    journal = Journal(str(tmp_path / 'journal.jsonl'))
+    tag_galleries = vicbot2.tag_galleries
+
+    def crash(ready_list, edits):
+        raise RuntimeError('crash')
+    monkeypatch.setattr(vicbot2, 'tag_galleries', crash)
+    with pytest.raises(RuntimeError):
+        run(wiki, journal, tmp_path)
+    # The tags went through and nothing else did
+    assert 'VI-add' in text(wiki, 'File:A.jpg') and 'VI-add' in text(wiki, 'File:B.jpg')
+    assert '|A.jpg' in text(wiki, CANDIDATE_LIST) and text(wiki, 'User talk:Alice') == 'Hello'
+
+    tagged(wiki)
+    monkeypatch.setattr(vicbot2, 'tag_galleries', tag_galleries)
+    promoted, failed = run(wiki, journal, tmp_path)
+    assert sorted(entry['image'] for entry in promoted) == ['A.jpg', 'B.jpg'] and failed == []
+    for image in ('A.jpg', 'B.jpg'):
+        assert text(wiki, 'File:{}'.format(image)).count('VI-add') == 1
+        assert '|' + image not in text(wiki, CANDIDATE_LIST)
+        assert text(wiki, 'User talk:Alice').count('{{VICpromoted|' + image) == 1
+        assert image in text(wiki, vicbot2.RECENTLY_PROMOTED_TITLE)
+        assert image in text(wiki, vicbot2.SCOPE_LIST_TITLE)
+    assert text(wiki, 'Cats').count('VI-tiny') == 2
+    assert journal.outstanding() == {} and journal.unfinished_promotions() == {}
+
+
+def test_crash_after_planning_everything_is_only_replayed(local_wiki, tmp_path, monkeypatch):
+    wiki = local_wiki(pages(protected=False))
+    journal = Journal(str(tmp_path / 'journal.jsonl'))
+    saved = []
+    journaled_save = vicbot2.journaled_save
+
+    def crash_after_the_tags(journal, run_id, edit):
+        # Dies for good once the tags are saved, leaving everything after them outstanding
+        if saved and not edit['title'].startswith('File:'):
+            raise SystemExit
+        saved.append(edit['title'])
+        journaled_save(journal, run_id, edit)
+    monkeypatch.setattr(vicbot2, 'journaled_save', crash_after_the_tags)
+    with pytest.raises(SystemExit):
+        run(wiki, journal, tmp_path)
+    assert '|A.jpg' in text(wiki, CANDIDATE_LIST) and text(wiki, 'User talk:Alice') == 'Hello'
+    assert journal.unfinished_promotions() == {} and journal.outstanding()
+
+    tagged(wiki)
+    monkeypatch.setattr(vicbot2, 'journaled_save', journaled_save)
+    promoted, failed = run(wiki, journal, tmp_path)
+    # The replay made the outstanding edits, candidate removal among them, which left this run nothing to do
+    assert promoted == [] and failed == []
+    for image in ('A.jpg', 'B.jpg'):
+        assert text(wiki, 'File:{}'.format(image)).count('VI-add') == 1
+        assert '|' + image not in text(wiki, CANDIDATE_LIST)
+        assert text(wiki, 'User talk:Alice').count('{{VICpromoted|' + image) == 1
+        assert text(wiki, vicbot2.RECENTLY_PROMOTED_TITLE).count(image) == 1
+    assert journal.outstanding() == {}
@@ -0,0 +1,56 @@
+import types
+
+import pytest
+
+import vicbot2
+from vicstate import Journal
+from vicwiki import LiveWiki, Wiki
+
+
+class FakeSite:
+    '''Just enough of a pywikibot site to save pages, answering every edit with response.'''
+
+    def __init__(self, response):
+        self.response = response
+        self.tokens = {'csrf': 'token'}
+        self.throttle = types.SimpleNamespace(writedelay=0)
+        self.requests = []
+
+    def simple_request(self, **params):
+        self.requests.append(params)
+        return types.SimpleNamespace(submit=lambda: self.response)
+
+
+def live_wiki(response):
+    wiki = LiveWiki.__new__(LiveWiki)
+    Wiki.__init__(wiki)
+    wiki.site = FakeSite(response)
+    return wiki
+
+
+def test_successful_edit():
+    wiki = live_wiki({'edit': {'result': 'Success', 'newrevid': 2}})
+    assert wiki.save_page('File:A.jpg', 'text', 'summary', baserevid=1)
+    assert wiki.site.requests[0]['baserevid'] == 1
+
+
+@pytest.mark.parametrize('failure, code', [
+    ({'result': 'Failure', 'captcha': {'type': 'image', 'id': '1'}}, 'captcha'),
+    ({'result': 'Failure', 'code': 'abusefilter-warning', 'info': 'Hit AbuseFilter: Test', 'warning': 'x'}, 'abusefilter-warning'),
+    ({'result': 'Failure', 'code': 'abusefilter-disallowed', 'info': 'Hit AbuseFilter: Test'}, 'abusefilter-disallowed'),
+    ({'result': 'Failure', 'spamblacklist': 'example.org'}, 'spamblacklist'),
+    ({'result': 'Failure'}, 'editfailure'),
+])
+def test_refused_edit_is_an_error(failure, code, monkeypatch, tmp_path):
+    wiki = live_wiki({'edit': failure})
+    with pytest.raises(vicbot2.pywikibot.exceptions.APIError) as error:
+        wiki.save_page('File:A.jpg', 'text', 'summary')
+    assert error.value.code == code
+    # The save counts as failed, and the journal keeps the edit outstanding
+    monkeypatch.setattr(vicbot2, 'wiki', wiki)
+    journal = Journal(str(tmp_path / 'journal.jsonl'))
+    edit = {'title': 'File:A.jpg', 'text': 'text', 'summary': 'summary', 'baserevid': 1}
+    journal.plan('run', [edit])
+    failures = vicbot2.SaveExecutor(interval=0).run([('File:A.jpg', lambda: vicbot2.journaled_save(journal, 'run', edit))])
+    assert failures == {'File:A.jpg': vicbot2.SAVE_ERRORS[code]}
+    assert journal.outstanding() == {'run': [edit]}
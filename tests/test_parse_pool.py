@@ -0,0 +1,23 @@
+from vicparse import ParsePool, bot_moves, vi_scopes
+
+FILE_PAGES = ['{{VI|Scope %d|x}}' % i if i % 3 else 'No template %d' % i for i in range(50)] + ['{{VI}}']
+GALLERY_LINES = ['File:A%d.jpg|{{VICbotMove|Scope %d|Topic}}' % (i, i) if i % 2 else 'File:B%d.jpg|text' % i for i in range(50)]
+
+
+def test_workers_give_the_results_in_order():
+    expected = (vi_scopes(FILE_PAGES), bot_moves(GALLERY_LINES))
+    pool = ParsePool(2, threshold=0)
+    try:
+        job = pool.submit(vi_scopes, FILE_PAGES)
+        assert (job.result(), pool.map(bot_moves, GALLERY_LINES)) == expected
+        # Workers aren't forked from a process which may be running other threads
+        assert pool.executor._mp_context.get_start_method() == 'forkserver'
+    finally:
+        pool.close()
+    assert expected[0][:3] == [None, 'Scope 1', 'Scope 2'] and expected[0][-1] == ''
+
+
+def test_small_jobs_stay_in_this_process():
+    pool = ParsePool(2)
+    assert pool.map(vi_scopes, FILE_PAGES) == vi_scopes(FILE_PAGES)
+    assert pool.executor is None
@@ -0,0 +1,149 @@
+import math
+import time
+
+import pytest
+
+import vicbot2
+import vicwiki
+from vicstate import Journal, StateStore
+
+CANDIDATE_LIST = 'Commons:Valued image candidates/candidate list'
+
+
+def nomination(image, scope, nominator):
+    return ('<noinclude>{{{{VIC-page-header}}}}</noinclude>\n'
+            '<includeonly>{{{{VIC-thumb</includeonly><noinclude>{{{{VIC</noinclude>\n'
+            '|image={}\n|scope={}\n|nominator=[[User:{}|{}]]\n|review={{{{VIC-support|[[User:Bob|Bob]]}}}}\n}}}}\n'
+            '== Discussion ==\n'.format(image, scope, nominator, nominator))
+
+
+def pages(protected):
+    return {
+        CANDIDATE_LIST: {'text': '<!-- VICBOT_ON -->\n===Cats===\n{{VICs\n|A.jpg\n|B.jpg\n}}'},
+        'Commons:Valued image candidates/Most valued review candidate list': {'text': '{{VICs\n}}'},
+        'Commons:Valued image candidates/A.jpg': {'text': nomination('A.jpg', '[[Cats]] (black)', 'Alice'),
+                                                  'categories': ['Category:Promoted valued image candidates']},
+        'Commons:Valued image candidates/B.jpg': {'text': nomination('B.jpg', '[[Cats]] (white)', 'Alice'),
+                                                  'categories': ['Category:Promoted valued image candidates']},
+        'File:A.jpg': {'text': 'A cat', 'protected': protected},
+        'File:B.jpg': {'text': 'Another cat'},
+        'User talk:Alice': {'text': 'Hello'},
+        vicbot2.RECENTLY_PROMOTED_TITLE: {'text': '<gallery>\n</gallery>'},
+        vicbot2.SCOPE_LIST_TITLE: {'text': '*[[:File:Z.jpg|Zebras]]'},
+        'Cats': {'text': '<gallery>\nFile:A.jpg|Black\nFile:B.jpg|White\n</gallery>'},
+        vicbot2.ERROR_PAGE_TITLE: {'text': ''},
+    }
+
+
+def run(local_wiki, tmp_path, protected):
+    wiki = local_wiki(pages(protected))
+    state = StateStore(str(tmp_path / 'state.db'))
+    try:
+        promoted, failed = vicbot2.run_stages(state, 'api', Journal(None))
+    finally:
+        state.close()
+    return wiki, promoted, failed
+
+
+def text(wiki, title):
+    return wiki.pages[title]['text']
+
+
+def test_promotion(local_wiki, tmp_path):
+    wiki, promoted, failed = run(local_wiki, tmp_path, protected=False)
+    assert sorted(entry['image'] for entry in promoted) == ['A.jpg', 'B.jpg'] and failed == []
+    assert 'VI-add' in text(wiki, 'File:A.jpg') and 'VI-add' in text(wiki, 'File:B.jpg')
+    assert '|A.jpg' not in text(wiki, CANDIDATE_LIST) and '|B.jpg' not in text(wiki, CANDIDATE_LIST)
+
+
+def test_failed_tag_keeps_the_candidate(local_wiki, tmp_path):
+    wiki, promoted, failed = run(local_wiki, tmp_path, protected=True)
+    assert [entry['image'] for entry in promoted] == ['B.jpg'] and failed == []
+    assert text(wiki, 'File:A.jpg') == 'A cat'
+    # A stays a candidate for the next run, and nothing else claims it was promoted
+    assert '|A.jpg' in text(wiki, CANDIDATE_LIST)
+    assert 'A.jpg' not in text(wiki, 'User talk:Alice')
+    assert 'A.jpg' not in text(wiki, vicbot2.RECENTLY_PROMOTED_TITLE)
+    assert 'File:A.jpg|Black\n' in text(wiki, 'Cats') and 'VI-tiny' not in text(wiki, 'Cats').split('\n')[1]
+    assert 'A.jpg' not in text(wiki, vicbot2.SCOPE_LIST_TITLE)
+    assert 'File:A.jpg' in text(wiki, vicbot2.ERROR_PAGE_TITLE)
+    # B went through all the same
+    assert 'VI-add' in text(wiki, 'File:B.jpg')
+    assert '|B.jpg' not in text(wiki, CANDIDATE_LIST)
+    assert 'B.jpg' in text(wiki, 'User talk:Alice')
+    assert 'B.jpg' in text(wiki, vicbot2.RECENTLY_PROMOTED_TITLE)
+    assert 'B.jpg' in text(wiki, vicbot2.SCOPE_LIST_TITLE)
+
+
+@pytest.mark.parametrize('protected', ['File:A.jpg', 'Cats'])
+def test_failed_save_only_affects_its_page(local_wiki, protected):
+    wiki = local_wiki({'File:A.jpg': {'text': 'a'}, 'File:B.jpg': {'text': 'b'}, 'Cats': {'text': 'c'}})
+    wiki.pages[protected]['protected'] = True
+    edits = vicbot2.PendingEdits()
+    for title in ('File:A.jpg', 'File:B.jpg', 'Cats'):
+        edits.edit(title, edits.get(title) + ' edited', 'test')
+    # Changed behind the buffer's back, the save is an edit conflict
+    wiki.pages['File:B.jpg']['revid'] += 1
+    failures = edits.commit(vicbot2.SaveExecutor(interval=0))
+    assert failures.keys() == {protected, 'File:B.jpg'}
+    assert all(title in failures or text(wiki, title).endswith(' edited') for title in ('File:A.jpg', 'File:B.jpg', 'Cats'))
+
+
+def test_saves_are_paced(local_wiki):
+    wiki = local_wiki({'Page {}'.format(i): {'text': ''} for i in range(20)})
+    interval = 0.05
+    executor = vicbot2.SaveExecutor(workers=4, interval=interval)
+    saves = [(title, lambda title=title: wiki.save_page(title, 'saved', 'test', True, None, False))
+             for title in wiki.pages]
+    started = time.monotonic()
+    assert executor.run(saves) == {}
+    elapsed = time.monotonic() - started
+    assert all(page['text'] == 'saved' for page in wiki.pages.values())
+    # One save per interval, however many workers there are
+    assert (len(saves) - 1) * interval <= elapsed < (len(saves) + 10) * interval
+
+
+def test_random_sample_waits_for_the_state_store(local_wiki, tmp_path, monkeypatch):
+    local_wiki(pages(protected=False))
+    path = str(tmp_path / 'state.db')
+    state = StateStore(path)
+    busy = []
+    monkeypatch.setattr(vicbot2, 'update_random_sample_at', lambda sample_path: busy.append(state.connection.in_transaction))
+    try:
+        vicbot2.run_stages(state, 'api', Journal(None), sample_path=path)
+    finally:
+        state.close()
+    # A write the state store hasn't committed yet would lock the VI pool out of the shared database
+    assert busy == [False]
+
+
+def test_saves_back_off_when_asked_to(local_wiki, monkeypatch):
+    # Keeps the widened interval short
+    monkeypatch.setattr(vicbot2, 'MAX_SAVE_INTERVAL', 0.01)
+    wiki = local_wiki({'Lagged': {'text': '', 'maxlag': 2}, 'Limited': {'text': '', 'ratelimited': 1},
+                       'Hopeless': {'text': '', 'maxlag': vicbot2.SAVE_ATTEMPTS}, 'Fine': {'text': ''}})
+    slowed = []
+    slow_down = vicbot2.RateLimiter.slow_down
+    monkeypatch.setattr(vicbot2.RateLimiter, 'slow_down', lambda limiter: slowed.append(1) or slow_down(limiter))
+    executor = vicbot2.SaveExecutor(interval=0)
+    saves = [(title, lambda title=title: wiki.save_page(title, 'saved', 'test')) for title in wiki.pages]
+    assert executor.run(saves) == {'Hopeless': 'server kept asking to slow down, gave up'}
+    assert len(slowed) == 3 + vicbot2.SAVE_ATTEMPTS
+    assert sorted(title for title, page in wiki.pages.items() if page['text'] == 'saved') == ['Fine', 'Lagged', 'Limited']
+
+
+def test_file_pages_are_resolved_once(local_wiki):
+    files = {'File:F{}.jpg'.format(i): {'text': 'f'} for i in range(60)}
+    files['File:F0.jpg']['templates'] = ['Template:VI']
+    files['File:F1.jpg'] = {'text': '#REDIRECT [[File:Moved.jpg]]', 'redirect': 'File:Moved.jpg'}
+    files['File:Moved.jpg'] = {'text': 'm'}
+    wiki = local_wiki(files)
+    ready_list = [{'image': 'F{}.jpg'.format(i), 'scope': 'Cats', 'subpage': 'F{}.jpg'.format(i)} for i in range(60)]
+    edits = vicbot2.PendingEdits()
+    ready, failed, tagged = vicbot2.skip_already_promoted(ready_list, [], edits)
+    assert failed == ['F0.jpg'] and len(ready) == 59 and tagged == []
+    vicbot2.promote_candidates(ready, edits)
+    assert len(vicbot2.save_promotions(ready, tagged, edits)) == 59
+    # Templates, text and redirects all come with one batched load, which promoting and saving reuse
+    assert wiki.recorder.stats['setup']['read']['count'] == math.ceil(len(ready_list) / vicwiki.BATCH_SIZE)
+    assert 'VI-add' in text(wiki, 'File:Moved.jpg') and 'VI-add' not in text(wiki, 'File:F0.jpg')
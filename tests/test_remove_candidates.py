@@ -0,0 +1,36 @@
+import pytest
+
+import vicbot2
+
+CANDIDATE_LIST, REVIEW_LIST = vicbot2.CANDIDATE_INPUT_PAGES
+
+
+@pytest.mark.parametrize('spelling', [
+    'Bird one.jpg',
+    'Bird_one.jpg',
+    'bird one.jpg',
+    'Bird one.jpg\u200e',
+    'Bird<!-- promoted? --> one.jpg',
+    'Bird&#32;one.jpg',
+    'Bird&#95;one.jpg',
+    '  Bird   one.jpg ',
+])
+def test_canonical_title(spelling):
+    assert vicbot2.canonical_title(spelling) == 'Bird one.jpg'
+
+
+def test_canonical_title_keeps_the_rest_of_the_case():
+    assert vicbot2.canonical_title('bird One.jpg') != vicbot2.canonical_title('Bird one.jpg')
+
+
+def test_remove_candidates(local_wiki):
+    local_wiki({
+        CANDIDATE_LIST: {'text': '===Birds===\n{{VICs\n|Bird_one.jpg\u200e\n|Bird two.jpg\n|bird three.jpg<!-- x -->\n}}\n'
+                                 '===Cats===\n{{vICs\n|Cat&amp;dog.jpg\n|Cat.jpg\n}}\n{{Other\n|Cat.jpg\n}}'},
+        REVIEW_LIST: {'text': '{{VICs\n|Bird one.jpg\n}}\n{{VICs\n|Bird four.jpg\n}}'},
+    })
+    edits = vicbot2.PendingEdits()
+    vicbot2.remove_candidates(['Bird one.jpg', 'Bird three.jpg', 'Cat&dog.jpg', 'Cat.jpg'], edits)
+    assert edits.get(CANDIDATE_LIST) == '===Birds===\n{{VICs\n|Bird two.jpg\n}}\n===Cats===\n{{vICs\n}}\n{{Other\n|Cat.jpg\n}}'
+    # Reviews are taken off whole
+    assert edits.get(REVIEW_LIST) == '\n{{VICs\n|Bird four.jpg\n}}'
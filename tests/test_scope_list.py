@@ -0,0 +1,17 @@
+import vicbot2
+
+TEXT = 'Intro\n*[[:File:B.jpg|Bats]]\n*[[:Image:D.jpg|Dogs]]\n*[[:File:F.jpg|Frogs]]\n\n[[Category:Valued images]]'
+
+
+def test_merge_scope_list():
+    new = [('A.jpg', '[[Ants]]'), ('C.jpg', "''Cats''"), ('E.jpg', 'Eels'), ('G.jpg', 'Goats'), ('H.jpg', 'Hens'),
+           ('D2.jpg', 'dogs')]
+    assert vicbot2.merge_scope_list(TEXT, new) == (
+        'Intro\n*[[:File:A.jpg|Ants]]\n*[[:File:B.jpg|Bats]]\n*[[:File:C.jpg|Cats]]\n*[[:Image:D.jpg|Dogs]]\n'
+        '*[[:File:E.jpg|Eels]]\n*[[:File:F.jpg|Frogs]]\n*[[:File:G.jpg|Goats]]\n*[[:File:H.jpg|Hens]]\n\n'
+        '[[Category:Valued images]]')
+
+
+def test_merge_scope_list_without_anything_new():
+    assert vicbot2.merge_scope_list(TEXT, [('B2.jpg', "'''Bats'''")]) is TEXT
+    assert vicbot2.merge_scope_list('No list here', [('A.jpg', 'Ants')]) == 'No list here'
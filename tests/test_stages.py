@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+import pytest
+
+import vicbot2
+from test_promotion import CANDIDATE_LIST, pages, text
+from vicstate import Journal, StateStore
+
+
+def test_failed_stage_leaves_unrelated_stages_running(local_wiki):
+    local_wiki({})
+    done = []
+
+    def fail():
+        raise RuntimeError('broken')
+
+    def slow():
+        time.sleep(0.05)
+        done.append('slow')
+    graph = {
+        'fail': (fail, []),
+        'slow': (slow, []),
+        'after_slow': (lambda _: done.append('after_slow'), ['slow']),
+        'after_fail': (lambda _: done.append('after_fail'), ['fail']),
+    }
+    with pytest.raises(RuntimeError, match='broken'):
+        asyncio.run(vicbot2.run_stage_graph(graph))
+    assert done == ['slow', 'after_slow']
+
+
+def test_failed_sample_does_not_stop_the_promotions(local_wiki, tmp_path, monkeypatch):
+    wiki = local_wiki(pages(protected=False))
+    path = str(tmp_path / 'state.db')
+
+    def update_random_sample(pool):
+        pool.set_meta('half', 'done')
+        raise RuntimeError('replica went away')
+    monkeypatch.setattr(vicbot2, 'update_random_sample', update_random_sample)
+    state = StateStore(path)
+    try:
+        promoted, _ = vicbot2.run_stages(state, 'api', Journal(None), sample_path=path)
+        # The VI pool let go of the shared database, or this would wait for it and fail
+        state.set_meta('other', 'value')
+    finally:
+        state.close()
+    assert len(promoted) == 2
+    assert '|A.jpg' not in text(wiki, CANDIDATE_LIST) and 'A.jpg' in text(wiki, 'User talk:Alice')
+    assert 'replica went away' in text(wiki, vicbot2.ERROR_PAGE_TITLE)
@@ -0,0 +1,51 @@
+import pytest
+
+import vicbot2
+
+PAGES = {
+    'Commons:Valued image candidates/A.jpg': {'text': '', 'categories': ['Category:Promoted valued image candidates']},
+    'Commons:Valued image candidates/B.jpg': {'text': '', 'categories': ['Category:Nominated valued image candidates']},
+    'Commons:Valued image candidates/C d.jpg': {'text': '', 'categories': ['Category:Declined valued image candidates']},
+    # In two status categories, the later status in VIC_STATUSES wins
+    'Commons:Valued image candidates/E.jpg': {'text': '', 'categories': ['Category:Nominated valued image candidates',
+                                                                         'Category:Withdrawn valued image candidates']},
+    'Commons:Valued image candidates/F.jpg': {'text': '', 'categories': ['Category:Some other category']},
+    # Status categories outside the Commons namespace don't count
+    'File:A.jpg': {'text': '', 'categories': ['Category:Promoted valued image candidates']},
+}
+
+EXPECTED = {
+    'Commons:Valued image candidates/A.jpg': 'Promoted',
+    'Commons:Valued image candidates/B.jpg': 'Nominated',
+    'Commons:Valued image candidates/C d.jpg': 'Declined',
+    'Commons:Valued image candidates/E.jpg': 'Withdrawn',
+}
+
+
+@pytest.mark.parametrize('backend', ['api', 'sql'])
+def test_status_index(local_wiki, backend):
+    wiki = local_wiki(PAGES)
+    assert vicbot2.build_status_index(backend) == EXPECTED
+    # A fixed number of requests, however many candidates there are
+    stats = wiki.recorder.stats['setup']
+    if backend == 'api':
+        assert stats['read']['count'] == len(vicbot2.VIC_STATUSES)
+    else:
+        assert stats['sql']['count'] == 1
+        assert 'read' not in stats
+
+
+def test_status_index_request_count_is_fixed(local_wiki):
+    pages = {'Commons:Valued image candidates/{}.jpg'.format(i): {'text': '', 'categories': ['Category:Supported valued image candidates']}
+             for i in range(500)}
+    wiki = local_wiki(pages)
+    index = vicbot2.build_status_index('api')
+    assert len(index) == 500 and set(index.values()) == {'Supported'}
+    assert wiki.recorder.stats['setup']['read']['count'] == len(vicbot2.VIC_STATUSES)
+
+
+def test_sql_falls_back_to_api(local_wiki):
+    local_wiki(PAGES)
+    vicbot2.replica.close()
+    assert vicbot2.build_status_index('sql') == EXPECTED
+    assert any(kind == 'MySQL error' for _, _, _, kind in vicbot2.errors.entries)
@@ -0,0 +1,80 @@
+import os
+import random
+
+import pytest
+
+from vicparse import Nomination, extract_nomination, nomination_from_tree
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nominations')
+PAGES = sorted(os.listdir(CORPUS))
+# Pages the extractor has to read itself, rather than leaving them to the parser
+EXTRACTED = {'Apis mellifera on lavender.jpg.txt', 'Bird one.jpg.txt', 'Duplicate scope.jpg.txt', 'Link in scope.jpg.txt',
+             'Math scope.jpg.txt', 'Missing nominator.jpg.txt', 'Nested review.jpg.txt', 'Old style.jpg.txt',
+             'Parus major 2 (Lukasz Lukasik).jpg.txt', 'Ponte Vecchio at dusk.jpg.txt', 'Positional.jpg.txt',
+             'Review with ref.jpg.txt', 'Sagrada Familia nave.jpg.txt', 'Tussilago farfara flower.jpg.txt', 'VICs first.jpg.txt'}
+# Bits of wikitext random texts are assembled from for the differential test
+PIECES = ['{{', '}}', '[[', ']]', '|', '=', ' ', 'a', '_', '\n', '<!--', '-->', '<nowiki>', '</nowiki>', '<noinclude>', '</NOINCLUDE>',
+          '<span>', '</span>', '<small>', '</small>', '<br>', '<br/>', '<ref name=x>', '</ref>', '{{{', '}}}', 'image', 'scope',
+          'nominator', 'subpage', 'review', '<includeonly>{{VIC-thumb</includeonly>', '{{VIC', '{{ VIC ', '{{VICs', '{{foo|',
+          '[[User:X|X]]', '<', '>', 'x=y', '<!--c-->', '<noinclude>{{VIC-page-header}}</noinclude>\n', '<pre>', '</pre>',
+          '<syntaxhighlight lang="x">', '</syntaxhighlight>', '<source>', '</source>', '<math>', '</math>', '<gallery>',
+          '</gallery>', '<PRE>', '<pre/>', '<div>', '</div>', '\n{| class=x\n', '\n|}', '\n! a !! b\n', '{|',
+          '[http://example.org ', '[https://example.org/a=b ', '[//example.org ', '[', ']', 'http://example.org']
+
+
+def read(name):
+    with open(os.path.join(CORPUS, name)) as infile:
+        return infile.read()
+
+
+@pytest.mark.parametrize('name', PAGES)
+def test_extractor_agrees_with_the_parser(name):
+    text = read(name)
+    nomination = extract_nomination(text)
+    if name in EXTRACTED:
+        assert nomination is not None
+    if nomination is not None:
+        assert nomination == nomination_from_tree(text)
+
+
+@pytest.mark.parametrize('text', [
+    '<pre>{{VIC|image=Example.jpg|scope=x|nominator=[[User:Y]]}}</pre>\n{{VIC|image=Real.jpg|scope=y|nominator=[[User:Z]]}}',
+    '<syntaxhighlight lang="wikitext">{{VIC|image=Example.jpg}}</syntaxhighlight>{{VIC|image=Real.jpg}}',
+    '<SOURCE>{{VIC|image=Example.jpg}}</source>{{VIC|image=Real.jpg}}',
+    '<math>{{VIC|image=Example.jpg}}</math>{{VIC|image=Real.jpg}}',
+    '<gallery>\nFile:Example.jpg|{{VIC|image=Example.jpg}}\n</gallery>{{VIC|image=Real.jpg}}',
+    '<nowiki>{{VIC|image=Example.jpg}}</nowiki>{{VIC|image=Real.jpg}}',
+    '<!-- {{VIC|image=Example.jpg}} -->{{VIC|image=Real.jpg}}',
+])
+def test_examples_shown_as_text_are_left_to_the_parser(text):
+    assert extract_nomination(text) is None
+    assert nomination_from_tree(text).image == 'Real.jpg'
+
+
+@pytest.mark.parametrize('text', [
+    '<pre><br>{{VIC|}}<span></pre>',
+    '<math><br/>{{VIC|}}<!--<math>',
+    '{{VIC\n|<ref><pre/><pre></ref>\n}}</pre>',
+    '{{VIC|review=\n{| class="wikitable"\n| a || b\n|}\n}}',
+    '{{VIC|image=A.jpg|scope=[http://example.org Birds|of prey]|nominator=[[User:A|A]]}}',
+    '{{VIC|image=A.jpg|scope=[//example.org Birds|of prey]}}',
+    '{{VIC|image=A.jpg|[http://example.org/?a=b x]}}',
+])
+def test_unsure_cases_are_left_to_the_parser(text):
+    assert extract_nomination(text) is None
+
+
+def test_closed_tags_before_the_template():
+    text = '<pre>{{Example|a}}</pre><pre/>\n{{VIC|image=Real.jpg|scope=y}}'
+    assert extract_nomination(text) == nomination_from_tree(text) == Nomination('Real.jpg', 'y')
+
+
+def test_extractor_agrees_with_the_parser_on_random_texts():
+    rng = random.Random(1)
+    for _ in range(5000):
+        parts = [rng.choice(PIECES) for _ in range(rng.randint(0, 25))]
+        parts.insert(rng.randint(0, len(parts)), rng.choice(['{{VIC|', '{{VIC\n|', '<noinclude>{{VIC</noinclude><includeonly>{{VIC-thumb</includeonly>|']))
+        text = ''.join(parts)
+        nomination = extract_nomination(text)
+        if nomination is not None:
+            assert nomination == nomination_from_tree(text), text
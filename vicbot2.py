@@ -1,154 +1,675 @@
 '''Ground-up rewrite of VICbot.'''
+import asyncio
+import bisect
+import concurrent.futures
+import contextvars
+import functools
+import hashlib
+import html
+import json
+import os
 import re
+import sys
+import threading
+import time
 
 import mwparserfromhell
-import MySQLdb
 import pywikibot
 import pywikibot.pagegenerators
 import pywikibot.textlib
 from loguru import logger
 
+from vicerrors import ErrorCollector
+from vicfeed import FileFeed, RecentChangesFeed
+from vicparse import PARALLEL_PARSE_THRESHOLD, Nomination, ParsePool, bot_moves, extract_nomination, nominations_from_trees, vi_scopes
+from vicreplica import STREAM_CHUNK_SIZE, LocalReplica, Replica, ReplicaError
+from vicstate import JOURNAL_PATH, STATE_DB_PATH, Journal, StateStore, VIPool
+from vicstats import RUN_HISTORY_PATH, Recorder
+from vicwiki import LiveWiki, LocalWiki
+
 TASK_MESSAGE = 'VICBot2 [[Commons:Bots/Requests/VICBot2|task 1]] (maintain VIC):'
 USER_PARSER_RE = re.compile(r'\[\[User:(.*?)(?:\|.*)?\]\]', re.I)
+# Regexes of the old bot for turning a scope into plain text: links, one-letter templates and bold/italics
+LINK2_RE = re.compile(r'\[\[(?:[^\|\]]+\|){0,1}([^\|\]]+)\]\]')
+LINK3_RE = re.compile(r'\{\{\w\|([^\|\}]+)\}\}')
+QUOTES_RE = re.compile("'{2,3}")
+# First plain link of a scope, which names its gallery
+LINK_RE = re.compile(r'\[\[([^\|\]:]+)[^\]]*\]\]')
+# A line of a gallery: namespace and image
+GALLERY_RE = re.compile(r'^\s*([Ii]mage|[Ff]ile):([^\|]+)')
+# An entry of the alphabetical list: image and scope
+SCOPE_LIST_RE = re.compile(r'\*\s*\[\[:(?:[Ii]mage|[Ff]ile):([^\|\]]+).*\|(.+)\]\]\s*$')
 CANDIDATE_INPUT_PAGES =  ['Commons:Valued image candidates/candidate list',
                           'Commons:Valued image candidates/Most valued review candidate list']
-error_page_content = ''
+VIC_PREFIX = 'Commons:Valued image candidates/'
+RECENTLY_PROMOTED_TITLE = 'Commons:Valued images/Recently promoted'
+SAMPLE_TITLE = 'Commons:Valued images/sample'
+SCOPE_LIST_TITLE = 'Commons:Valued images by scope'
+TOPIC_PREFIX = 'Commons:Valued images by topic/'
+# Images which couldn't be tagged in the gallery of their scope, for people to do by hand
+TAG_GALLERIES_TITLE = VIC_PREFIX + 'tag_galleries'
+# Edits by the bot itself never make the daemon run again
+BOT_USER = 'VICBot2'
+# Status categories, in the order the API lists them. A page sitting in several
+# of them gets the last one, like the old walk over vic_page.categories() did.
+VIC_STATUSES = ['Declined', 'Discussed', 'Nominated', 'Opposed', 'Promoted', 'Supported', 'Undecided', 'Withdrawn']
+SAMPLE_SIZE = 4
+# Rounds of picking replacements for sampled files which turned out to be stale
+SAMPLE_ATTEMPTS = 3
+# Seconds between full syncs of the local VI pool with the replica
+VI_POOL_FULL_REFRESH = 24 * 60 * 60
+# Saves run on this many threads, paced by the configured put_throttle
+SAVE_WORKERS = 4
+SAVE_ATTEMPTS = 5
+# Upper bound for the save interval after repeated maxlag/ratelimited responses
+MAX_SAVE_INTERVAL = 120
+# API error codes which only affect the page being saved
+SAVE_ERRORS = {
+    'editconflict': 'edit conflict',
+    'articleexists': 'page was created in the meantime',
+    'protectedpage': 'page is protected',
+    'cascadeprotected': 'page is cascade-protected',
+    'sectionsnotsupported': 'page does not support sections',
+    'spamblacklist': 'spam blacklist hit',
+    'abusefilter-disallowed': 'disallowed by an abuse filter',
+    'abusefilter-warning': 'an abuse filter warned about the edit',
+    'captcha': 'a captcha was asked for',
+    'editfailure': 'edit refused without a reason',
+}
+# Seconds between two polls of the recent changes in daemon mode
+DAEMON_POLL_INTERVAL = 10
+# A batch of relevant changes is processed after a poll brings nothing new, or this many seconds after it began
+DAEMON_MAX_DELAY = 60
+# Seconds between refreshes of the random sample in daemon mode
+DAEMON_SAMPLE_INTERVAL = 60 * 60
+ERROR_PAGE_TITLE = 'User:VICBot2/errors'
+AUDIT_REPORT_PATH = os.path.expanduser('~/vicbot2-audit.txt')
+# Wiki and replica backends, the error collector and the parser pool for this run, set up by main()
+wiki = None
+replica = None
+errors = None
+parse_pool = None
+
+
+def parse_wikitext(text):
+    '''mwparserfromhell.parse, with the time it takes recorded for the current stage.'''
+    with wiki.recorder.record('parse'):
+        return mwparserfromhell.parse(text)
+
+
+def parse_all(function, texts):
+    '''parse_pool.map, with the parses and the time they take recorded for the current stage.'''
+    if not texts:
+        return []
+    with wiki.recorder.record('parse', len(texts)):
+        return parse_pool.map(function, texts)
+
+
+def parse_page(record, take=False):
+    '''
+    Parse tree of a page record from wiki.load_pages, shared by every stage reading the same revision.
+
+    take: the caller is going to modify the tree, so it gets one which isn't shared
+    '''
+    return wiki.cache.tree(record['title'], record['revid'], record['text'], parse_wikitext, take)
+
+
+def status_members_api():
+    '''
+    List the members of every VIC status category through the categorymembers API.
+
+    Returns a dict mapping each status to a list of page titles.
+    '''
+    return {status: wiki.category_members('Category:{} valued image candidates'.format(status), namespace=4)
+            for status in VIC_STATUSES}
+
+
+def status_members_sql():
+    '''
+    List the members of every VIC status category with a single replica query.
+
+    Returns a dict mapping each status to a list of page titles.
+    '''
+    members = {status: [] for status in VIC_STATUSES}
+    categories = {'{}_valued_image_candidates'.format(status): status for status in VIC_STATUSES}
+    rows = replica.query('select page_title, cl_to from categorylinks, page where page_id=cl_from and page_namespace=4 and cl_to in ({})'.format(
+                         ', '.join(['%s'] * len(categories))), list(categories))
+    for page_title, category in rows:
+        members[categories[category]].append('Commons:{}'.format(page_title.replace('_', ' ')))
+    return members
+
+
+def build_status_index(backend='api'):
+    '''
+    Build a lookup from VIC subpage title to its discussion status.
+
+    The handful of status categories is listed once per run, so resolving the
+    status of any number of candidates costs a fixed number of requests.
+
+    backend: 'api' to use categorymembers, 'sql' to query the replica categorylinks table
+    '''
+    members = None
+    if backend == 'sql':
+        try:
+            members = status_members_sql()
+        except ReplicaError as message:
+            logger.error('MySQL Error {}, falling back to the API'.format(message))
+            errors.report('candidate status lookup', 'MySQL error')
+    if members is None:
+        members = status_members_api()
+    index = {}
+    for status in VIC_STATUSES:
+        for title in members[status]:
+            index[title] = status
+    return index
+
+
+class RateLimiter:
+    '''
+    Hands out evenly spaced slots to any number of threads.
+
+    interval: seconds between two slots, widened by slow_down() and narrowed
+    back towards the starting value by speed_up()
+    '''
+
+    def __init__(self, interval):
+        self.base_interval = interval
+        self.interval = interval
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+    def slow_down(self):
+        with self.lock:
+            self.interval = min(max(self.interval * 2, 1), MAX_SAVE_INTERVAL)
+            logger.warning('Server asked us to slow down, saving every {} seconds'.format(self.interval))
+
+    def speed_up(self):
+        with self.lock:
+            self.interval = max(self.base_interval, self.interval * 0.9)
+
+
+class SaveExecutor:
+    '''
+    Runs saves on a bounded pool of worker threads, paced by a shared RateLimiter.
+
+    The limiter starts at the wiki's edit interval (the configured put_throttle)
+    and takes over from pywikibot's own write throttle while saves are running,
+    so the time spent on the request itself overlaps with waiting for the next slot. maxlag and
+    ratelimited responses widen the interval and retry the page; other
+    failures only affect the page they happened on.
+    '''
+
+    def __init__(self, workers=SAVE_WORKERS, interval=None):
+        self.workers = workers
+        self.limiter = RateLimiter(wiki.edit_interval if interval is None else interval)
+
+    def _save(self, save):
+        for _ in range(SAVE_ATTEMPTS):
+            self.limiter.wait()
+            try:
+                save()
+            except pywikibot.exceptions.MaxlagTimeoutError:
+                self.limiter.slow_down()
+                continue
+            except pywikibot.exceptions.APIError as error:
+                if error.code in ('maxlag', 'ratelimited'):
+                    self.limiter.slow_down()
+                    continue
+                return SAVE_ERRORS.get(error.code, 'API error {}'.format(error.code))
+            except pywikibot.exceptions.Error as error:
+                return str(error)
+            self.limiter.speed_up()
+            return None
+        return 'server kept asking to slow down, gave up'
+
+    def run(self, saves):
+        '''
+        Perform all saves.
+
+        saves: list of (title, callable) pairs, the callable does the actual save
+        Returns a dict mapping the title of each failed save to a description of the problem.
+        '''
+        failures = {}
+        if not saves:
+            return failures
+        with wiki.own_write_pacing(), concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # Each save gets a copy of the caller's context, so it is recorded for the caller's stage
+            futures = {pool.submit(contextvars.copy_context().run, self._save, save): title for title, save in saves}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    problem = future.result()
+                except Exception as error:
+                    logger.exception('Unexpected error saving {}'.format(futures[future]))
+                    problem = 'unexpected error {}'.format(type(error).__name__)
+                if problem:
+                    logger.warning('Could not save {}: {}'.format(futures[future], problem))
+                    failures[futures[future]] = problem
+        return failures
+
+
+class PendingEdits:
+    '''
+    Run-scoped buffer of page edits.
+
+    Stages read and change page text through the buffer instead of saving
+    directly. commit() then saves each changed page exactly once, with the
+    edit summaries of every stage which touched it combined.
+
+    Messages which only add to a page, such as notifications, are buffered
+    as new sections with add_section() instead. Those pages are never
+    downloaded, and each section is posted with an edit of its own.
+
+    Stages running at the same time may share the buffer, as long as they
+    edit different pages.
+
+    journal: vicstate.Journal to write the edits down in before they are made
+    '''
+
+    def __init__(self, journal=None):
+        self.pages = {}
+        # Redirects loaded with preload(redirects=True) -> their targets
+        self.aliases = {}
+        self.sections = []
+        self.lock = threading.Lock()
+        self.journal = journal or Journal(None)
+
+    def preload(self, titles, redirects=False, templates=None):
+        '''
+        Load all of titles which aren't buffered yet with batched requests.
+
+        redirects: follow redirects, including double ones, and buffer the target instead of the redirect
+        templates: list of template titles, remember which of them each page transcludes for transcludes()
+        Returns a dict mapping each of titles to the title it is buffered under.
+        A redirect loaded this way stands for its target in every other method too.
+        '''
+        with self.lock:
+            missing = [title for title in titles if title not in self.pages and title not in self.aliases]
+        records = wiki.load_pages(missing, redirects=redirects, templates=templates) if missing else {}
+        with self.lock:
+            for title, record in records.items():
+                if record['title'] != title and redirects:
+                    self.aliases[title] = record['title']
+                self.pages.setdefault(record['title'] if redirects else title, {
+                    'exists': record['exists'],
+                    'revid': record['revid'],
+                    'original': record['text'],
+                    'text': record['text'],
+                    'templates': record['templates'],
+                    'summaries': [],
+                    'minor': True,
+                })
+            return {title: self.aliases.get(title, title) for title in titles}
+
+    def exists(self, title):
+        return self.pages[self.preload([title])[title]]['exists']
+
+    def transcludes(self, title, template):
+        '''Whether a page transcluded a template when loaded, for templates preload() was asked about.'''
+        return template in self.pages[self.preload([title])[title]]['templates']
+
+    def get(self, title):
+        '''Current text of a page, including edits buffered earlier in this run.'''
+        return self.pages[self.preload([title])[title]]['text']
 
+    def parsed(self, title):
+        '''
+        Parse tree of the buffered text of a page, for the caller to modify and pass back to edit().
 
-def update_random_sample():
+        As long as nothing was buffered for the page, the tree parsed by
+        an earlier stage for the same revision is reused.
+        '''
+        title = self.preload([title])[title]
+        pending = self.pages[title]
+        return parse_page({'title': title, 'revid': pending['revid'], 'text': pending['text']}, take=True)
+
+    def edit(self, title, text, summary, minor=True):
+        '''
+        Replace the buffered text of a page.
+
+        summary: what this change does, without the TASK_MESSAGE prefix
+        minor: the combined edit is only marked minor if all its parts are
+        '''
+        title = self.preload([title])[title]
+        with self.lock:
+            pending = self.pages[title]
+            pending['text'] = str(text)
+            if summary not in pending['summaries']:
+                pending['summaries'].append(summary)
+            pending['minor'] = pending['minor'] and minor
+
+    def add_section(self, title, heading, text, summary, minor=False):
+        '''
+        Buffer text to be posted as a new section at the end of a page.
+
+        Redirects are followed when committing. Pages which can't take a new
+        section, because of their content model, are reported on the error page.
+        summary: what this change does, without the TASK_MESSAGE prefix
+        '''
+        with self.lock:
+            self.sections.append({'title': title, 'heading': heading, 'text': text, 'summary': summary, 'minor': minor})
+
+    def discard(self, title):
+        '''Drop whatever was buffered for a page, it is left as it was loaded.'''
+        title = self.preload([title])[title]
+        with self.lock:
+            pending = self.pages[title]
+            pending['text'] = pending['original']
+            pending['summaries'] = []
+            pending['minor'] = True
+
+    def commit(self, executor=None, titles=None):
+        '''
+        Save every page whose text changed, one edit per page.
+
+        executor: SaveExecutor to run the saves on, a default one is used otherwise
+        titles: only save these pages and leave everything else, new sections included, buffered.
+            Without it these are the last edits of the run, which the journal is told.
+        Failed saves are reported on the error page, the other saves still go through.
+        Returns a dict mapping the title of each failed save to a description of the problem.
+        '''
+        if titles is not None:
+            titles = set(self.preload(titles).values())
+        # Other stages may still be buffering while part of the edits is saved
+        with self.lock:
+            pages = [(title, pending) for title, pending in self.pages.items() if titles is None or title in titles]
+        planned = []
+        for title, pending in pages:
+            if pending['text'] == pending['original']:
+                continue
+            logger.info('Saving {}'.format(title))
+            planned.append({'title': title, 'text': pending['text'],
+                            'summary': '{} {}'.format(TASK_MESSAGE, '; '.join(pending['summaries'])),
+                            'minor': pending['minor'], 'baserevid': pending['revid'], 'create_only': not pending['exists']})
+        sections = self.sections if titles is None else []
+        # Only metadata of the pages getting new sections, the revid is what the journal checks on replay
+        targets = wiki.load_pages([section['title'] for section in sections], content=False, redirects=True)
+        for section in sections:
+            target = targets[section['title']]
+            if target['content_model'] != 'wikitext':
+                logger.warning('{} is {}, cannot add a section'.format(target['title'], target['content_model']))
+                errors.report('posting to', 'page is {}, post "{}" by hand'.format(target['content_model'], section['heading']),
+                              target['title'])
+                continue
+            logger.info('Adding a section to {}'.format(target['title']))
+            planned.append({'title': target['title'], 'text': section['text'],
+                            'summary': '{} {}'.format(TASK_MESSAGE, section['summary']), 'minor': section['minor'],
+                            'baserevid': target['revid'], 'create_only': False, 'section_title': section['heading']})
+        if titles is None:
+            self.sections = []
+        run_id = wiki.recorder.run_id
+        self.journal.plan(run_id, planned, last=titles is None)
+        saves = [(edit['title'], functools.partial(journaled_save, self.journal, run_id, edit)) for edit in planned]
+        failures = (executor or SaveExecutor()).run(saves)
+        for title, _ in saves:
+            if title in failures:
+                errors.report('saving', failures[title], title)
+            elif title in self.pages:
+                self.pages[title]['original'] = self.pages[title]['text']
+        return failures
+
+
+def journaled_save(journal, run_id, edit):
+    '''
+    Make an edit written down in the journal and mark it done there.
+
+    edit: keyword arguments for wiki.save_page, as given to Journal.plan
+    '''
+    wiki.save_page(**edit)
+    journal.done(run_id, edit['title'], edit['baserevid'])
+
+
+def replay_journal(journal):
+    '''
+    Make the edits which unfinished runs left outstanding, before this run reads anything.
+
+    An edit is only made again if its page is still at the revid the edit
+    was based on. Otherwise either it went through just before the crash, or
+    the page was changed since and this run works out the change afresh.
+
+    Runs which crashed after tagging promoted images but before planning the
+    rest of those promotions stay unfinished, for this run to finish them.
+    Returns a dict mapping the run id of each such run to its promotion entries.
+    '''
+    unfinished = journal.unfinished_promotions()
+    for run_id, planned in journal.outstanding().items():
+        logger.info('Resuming {} outstanding edits of unfinished run {}'.format(len(planned), run_id))
+        current = wiki.load_pages([edit['title'] for edit in planned], content=False)
+        saves = []
+        for edit in planned:
+            if current[edit['title']]['revid'] != edit['baserevid']:
+                logger.info('{} changed since run {} planned to edit it, not replaying'.format(edit['title'], run_id))
+                continue
+            saves.append((edit['title'], functools.partial(journaled_save, journal, run_id, edit)))
+        failures = SaveExecutor().run(saves)
+        for title in failures:
+            errors.report('resuming an unfinished run, saving', failures[title], title)
+        if run_id not in unfinished:
+            journal.finish(run_id)
+    for run_id, entries in unfinished.items():
+        logger.info('Run {} crashed while promoting {}, finishing those promotions'.format(
+            run_id, ', '.join(entry['image'] for entry in entries)))
+    return unfinished
+
+
+def refresh_vi_pool(pool):
+    '''
+    Bring the local pool of valued images up to date with the replica.
+
+    Most runs only ask for VI files with a page_id above the highest one in the
+    pool. Once every VI_POOL_FULL_REFRESH seconds the whole list is synced, which
+    picks up older files that were promoted and drops demoted ones. Neither query
+    sorts the table.
+    '''
+    last_full_refresh = float(pool.get_meta('last_full_refresh', 0))
+    if time.time() - last_full_refresh > VI_POOL_FULL_REFRESH:
+        logger.info('Syncing the full VI pool')
+        chunks = replica.stream("select page_id, page_title from templatelinks, page where tl_title='VI' and tl_namespace=10 and page_namespace=6 and page_id=tl_from")
+        pool.sync((page_id, page_title.replace('_', ' ')) for chunk in chunks for page_id, page_title in chunk)
+    else:
+        rows = replica.query("select page_id, page_title from templatelinks, page where tl_title='VI' and tl_namespace=10 and page_namespace=6 and page_id=tl_from and page_id > %s",
+                             (pool.max_page_id(),))
+        for page_id, page_title in rows:
+            pool.add(page_id, page_title.replace('_', ' '))
+
+
+def update_random_sample(pool):
     '''
     Update the random sample of valued images.
 
-    Get all pages which transclude {{VI}} in File: and pick four at random.
+    Pick four files at random from the local VI pool. The picks are checked for
+    still transcluding {{VI}} in one batched request; stale entries are dropped
+    from the pool and replaced. Files are only downloaded if their scope isn't
+    cached yet.
+
+    pool: VIPool
     '''
-    global error_page_content
     logger.info('Updating random VI sample page')
-    # MySQL statement copied from the original vicbot, see https://commons.wikimedia.org/wiki/User:VICbot/source
     try:
-        # Doing this via a mysql query is at least an order of magnitude faste rthan doing it through pywikibot
-        connection = MySQLdb.connect(host='commonswiki.labsdb', db='commonswiki_p', read_default_file='~/replica.my.cnf')
-        cursor = connection.cursor()
-        cursor.execute("select page_title from templatelinks, page where tl_title='VI' and tl_namespace=10 and page_namespace=6 and page_id=tl_from order by RAND() limit 4")
-        data = cursor.fetchall()
-    except MySQLdb.OperationalError as message:
+        refresh_vi_pool(pool)
+    except ReplicaError as message:
+        # The pool from earlier runs is still good enough for a sample
         logger.error('MySQL Error {}'.format(message))
-        error_page_content += '* In sample gallery generation: MySQL error\n'
-        data = None
-    finally:
-        cursor.close()
-        connection.close()
-    if not data:
+        errors.report('sample gallery generation', 'MySQL error')
+    sample = []
+    for _ in range(SAMPLE_ATTEMPTS):
+        sampled_ids = {entry[0] for entry in sample}
+        picks = [pick for pick in pool.sample(SAMPLE_SIZE - len(sample)) if pick[0] not in sampled_ids]
+        if not picks:
+            break
+        uncached = [pick for pick in picks if not pick[2]]
+        pages = wiki.load_pages(['File:{}'.format(pick[1]) for pick in picks if pick[2]], content=False, templates=['Template:VI'])
+        pages.update(wiki.load_pages(['File:{}'.format(pick[1]) for pick in uncached], templates=['Template:VI']))
+        valid = []
+        for page_id, title, scope in picks:
+            page = pages['File:{}'.format(title)]
+            if not page['exists'] or 'Template:VI' not in page['templates']:
+                logger.info('File:{} is no longer a valued image, dropping it from the pool'.format(title))
+                pool.remove(page_id)
+                continue
+            valid.append((page_id, title, scope))
+        # extract the scopes which aren't cached yet
+        scopes = iter(parse_all(vi_scopes, [pages['File:{}'.format(title)]['text'] for _, title, scope in valid if not scope]))
+        for page_id, title, scope in valid:
+            if not scope:
+                scope = next(scopes)
+                if not scope:
+                    logger.error('Unable to parse VI template on File:{}'.format(title))
+                    errors.report('sample gallery generation for', 'failed to parse VI template', 'File:{}'.format(title))
+                    continue
+                pool.set_scope(page_id, scope)
+            sample.append((page_id, title, scope))
+        if len(sample) == SAMPLE_SIZE:
+            break
+    if not sample:
         return
     sample_gallery_text = '<gallery>\n'
-    for row in data:
-        page = pywikibot.Page(pywikibot.Site(), 'File:{}'.format(row[0].decode()))
-        if not page.exists():
-            logger.error('Valued image page {} not found'.format(page.title()))
-            error_page_content += '* In sample gallery generation: Page {} not found\n'.format(page.as_link())
-            continue
-        scope = ''
-        # extract the scope
-        for template in mwparserfromhell.parse(page.text).filter_templates():
-            # Looking for the VI template
-            if template.name.upper() == 'VI':
-                scope = template.get(1).value
-                break
-        if not scope:
-            logger.error('Unable to parse VI template on {}'.format(page.title()))
-            error_page_content += '* In sample gallery generation: Failed to parse VI template on {}\n'.format(page.as_link())
-            continue
-
-        sample_gallery_text += '{}|{}\n'.format(page.title(), scope)
+    for _, title, scope in sample:
+        sample_gallery_text += 'File:{}|{}\n'.format(title, scope)
     sample_gallery_text += '</gallery>'
-    sample_page = pywikibot.Page(pywikibot.Site(), 'Commons:Valued_images/sample')
-    sample_page.text = sample_gallery_text
-    sample_page.save(summary=TASK_MESSAGE + ' prepare new random sample of four valued images')
+    wiki.save_page(SAMPLE_TITLE, sample_gallery_text, TASK_MESSAGE + ' prepare new random sample of four valued images')
 
 
-def find_candidate_list():
+def find_candidate_list(state):
     '''
     Get all candidates listed as ready for promotion.
+
+    state: StateStore, input pages which haven't changed since the last run are not parsed again
     '''
     candidate_list = set()
+    input_pages = wiki.load_pages(CANDIDATE_INPUT_PAGES, content=False)
+    changed = []
     for page_title in CANDIDATE_INPUT_PAGES:
-        candidate_input_page = pywikibot.Page(pywikibot.Site(), page_title)
-        for template in mwparserfromhell.parse(candidate_input_page.text).filter_templates():
+        stored = state.lookup(page_title, input_pages[page_title]['revid'])
+        if stored is None:
+            changed.append(page_title)
+        else:
+            logger.debug('{} unchanged since the last run'.format(page_title))
+            candidate_list.update(json.loads(stored))
+    for page_title, candidate_input_page in wiki.load_pages(changed).items():
+        page_candidates = set()
+        for template in parse_page(candidate_input_page).filter_templates():
             # hacky fix - sometimes there's a byte order mark hiding in the template name,
             # that breaks string comparison
             if re.sub('\u200e', '', str(template.name)).strip() == 'VICs':
                 for entry in template.params:
                     # Strip out any HTML comments and normalize on no-underscores for
-                    candidate_list.add(re.sub('<!--.*-->', '', str(entry), flags=re.S).strip().replace('_', ' '))
+                    page_candidates.add(re.sub('<!--.*-->', '', str(entry), flags=re.S).strip().replace('_', ' '))
+        state.record(page_title, candidate_input_page['revid'], json.dumps(sorted(page_candidates)))
+        candidate_list.update(page_candidates)
 
     return list(candidate_list)
 
 
-def find_promotion_ready(candidate_list):
+def load_nominations(titles):
+    '''
+    Load nomination pages and read their {{VIC}} template.
+
+    The template sits in the header section, so only section 0 is fetched
+    and the review discussion below it is left out. Pages whose header
+    section has no complete template are fetched again in full.
+    Returns a dict mapping each title to (page record, Nomination or None).
+    '''
+    def read(texts):
+        '''Nominations of texts, in order. Only texts extract_nomination can't read are parsed, on parse_pool.'''
+        with wiki.recorder.record('nomination', len(texts)):
+            nominations = [extract_nomination(text) for text in texts]
+        unread = [i for i, nomination in enumerate(nominations) if nomination is None]
+        for i, nomination in zip(unread, parse_all(nominations_from_trees, [texts[i] for i in unread])):
+            nominations[i] = nomination
+        return nominations
+
+    sections = wiki.load_pages(titles, section=0)
+    nominations = {title: (record, None) for title, record in sections.items()}
+    saved = sum(record['length'] - len(record['text'].encode()) for record in sections.values())
+    existing = [title for title, record in sections.items() if record['exists']]
+    for title, nomination in zip(existing, read([sections[title]['text'] for title in existing])):
+        nominations[title] = (sections[title], nomination)
+    incomplete = [title for title in existing if nominations[title][1] is None]
+    pages = wiki.load_pages(incomplete)
+    for title, nomination in zip(incomplete, read([pages[title]['text'] for title in incomplete])):
+        logger.debug('No complete VIC template in the header section of {}, fetched the full page'.format(title))
+        # Nothing was saved on this page, and its header section was downloaded for nothing
+        saved -= sections[title]['length']
+        nominations[title] = (pages[title], nomination)
+    if nominations:
+        logger.info('Fetched the header section of {} nominations, {} of them again in full, saving {} bytes'
+                    .format(len(nominations), len(incomplete), saved))
+        wiki.recorder.add('bytes_saved', saved)
+    return nominations
+
+
+def find_promotion_ready(candidate_list, status_index, state):
     '''
     Generates a list of images which can be promoted to VI.
 
+    Only revision metadata is fetched for every nomination. Nominations which
+    were not edited since the last run and are still undecided are skipped.
+
     candidate_list: list of images which are listed on the VIC candidate pages
+    status_index: VIC subpage title to status lookup from build_status_index
+    state: StateStore remembering the outcome of each nomination by revid
     '''
-    global error_page_content
 
     ready_to_promote = []
     failed_promotion = []
+    titles = {candidate: '{}{}'.format(VIC_PREFIX, candidate) for candidate in candidate_list}
+    metadata = wiki.load_pages(list(titles.values()), content=False)
+    changed = []
     for candidate in candidate_list:
-        vic_page = pywikibot.Page(pywikibot.Site(), 'Commons:Valued image candidates/{}'.format(candidate))
-        if not vic_page.exists():
+        title = titles[candidate]
+        status = status_index.get(title, '')
+        stored = state.lookup(title, metadata[title]['revid'])
+        if stored is not None and stored == status:
+            logger.debug('Candidate {} unchanged since the last run, no action needed'.format(candidate))
+            continue
+        if stored is not None and stored.startswith('* ') and status == 'Promoted' and errors.report_encoded(stored):
+            # Nomination still broken the same way as last run, no need to fetch it again
+            logger.debug('Candidate {} unchanged since the last run, reusing its error'.format(candidate))
+            continue
+        changed.append(candidate)
+    nominations = load_nominations([titles[candidate] for candidate in changed if status_index.get(titles[candidate]) == 'Promoted'])
+    for candidate in changed:
+        title = titles[candidate]
+        status = status_index.get(title, '')
+        vic_page, nomination = nominations.get(title, (metadata[title], None))
+        if not vic_page['exists']:
             logger.warning('VIC page for {} missing'.format(candidate))
-            error_page_content += '* In candidate evaluation for [[{}]]: VIC page missing\n'.format(candidate)
+            errors.report('candidate evaluation for', 'VIC page missing', candidate)
             continue
-        status = ''
-        for cat in vic_page.categories():
-            if 'valued image candidates' in cat.title():
-                status = cat.title().split(' ')[0].split(':')[1]
         # These categories aren't ready for action, skip
         if not status:
             logger.debug('Candidate {} does not have a VIC discussion category, no action needed'.format(candidate))
+            state.record(title, vic_page['revid'], status)
             continue
         elif status in ['Nominated', 'Discussed', 'Supported', 'Opposed']:
             logger.debug('Candidate {} has VIC discussion status {}, no action needed'.format(candidate, status))
+            state.record(title, vic_page['revid'], status)
             continue
         elif status in ['Declined', 'Undecided', 'Withdrawn']:
             failed_promotion.append(candidate)
             continue
         # This should only be stuff approved to promote
-        vic_page_text = vic_page.text
-        # normalize - the noinclude and includeonly tags mess up mwparserfromhell
-        vic_page_text = re.sub(r'<\/?noinclude>', '', vic_page_text, flags=re.I)
-        # there are two template starts between the noinclude/includeonly, so remove one
-        vic_page_text = vic_page_text.replace('<includeonly>{{VIC-thumb</includeonly>', '')
+        nomination = nomination or Nomination()
         entry = {}
-        entry['subpage'] = ''
-        entry['scope'] = ''
+        entry['subpage'] = nomination.subpage
+        entry['scope'] = nomination.scope
         entry['username'] = ''
-        entry['image'] = ''
-        entry['review'] = ''
-        nominator = ''
-        for template in mwparserfromhell.parse(vic_page_text).filter_templates():
-            # Looking for the VI template
-            if template.name.matches('VIC'):
-                try:
-                    # Explicit cast to str because these are all "wikicode" objects
-                    entry['scope'] = str(template.get('scope').value).strip()
-                    nominator = str(template.get('nominator').value).strip()
-                    entry['image'] = str(template.get('image').value).strip().replace('_', ' ')
-                except ValueError:
-                    # handled below
-                    pass
-
-                # These are their own sections because we want to try to resolve each
-                # even if the other failed
-                if template.has('subpage'):
-                    entry['subpage'] = str(template.get('subpage').value).strip()
-                if template.has('review'):
-                    entry['review'] = str(template.get('review').value).strip()
-                break
+        entry['image'] = nomination.image
+        entry['review'] = nomination.review
+        nominator = nomination.nominator
         if not entry['scope'] or not nominator or not entry['image']:
             # Can't finish the promotion
             logger.warning('Critical params missing from nomination for {}'.format(candidate))
-            error_page_content += '* In candidate evaluation for [[{}]]: missing critical parameters on nomination page\n'.format(candidate)
+            errors.report('candidate evaluation for', 'missing critical parameters on nomination page', candidate)
+            state.record(title, vic_page['revid'],
+                         errors.encode('candidate evaluation for', 'missing critical parameters on nomination page', candidate))
             continue
         if not entry['subpage']:
             entry['subpage'] = entry['image']
@@ -156,25 +677,99 @@ def find_promotion_ready(candidate_list):
             entry['username'] = USER_PARSER_RE.search(nominator).group(1)
         except:
             logger.warning('Unable to parse username from {}'.format(nominator))
-            error_page_content += '* In candidate evaluation for [[{}]]: unable to parse username\n'.format(candidate)
+            errors.report('candidate evaluation for', 'unable to parse username', candidate)
+            state.record(title, vic_page['revid'], errors.encode('candidate evaluation for', 'unable to parse username', candidate))
             continue
         ready_to_promote.append(entry)
+    # Nominations which left the candidate lists don't need tracking any more
+    evicted = state.evict(list(titles.values()) + CANDIDATE_INPUT_PAGES)
+    logger.debug('Evicted {} stale entries from the state store'.format(evicted))
     return ready_to_promote, failed_promotion
 
 
-def promote_candidates(ready_list):
-    user_notifications = {}
+def skip_already_promoted(ready_list, failed_list, edits, resumed=()):
+    '''
+    Leave out images which already carry {{VI}}, promoted by hand or by a run which didn't get to clean up.
+
+    All File pages are resolved and loaded into the edit buffer in one
+    batched step before anything is edited, along with whether they
+    transclude {{VI}}, so tagging them needs no further requests. Such
+    candidates are only taken off the candidate lists, unless a crashed run
+    tagged them and never got to the rest of their promotion.
+    resumed: promotion entries of crashed runs, as returned by replay_journal
+    Returns the ready list and the failed list, with already promoted
+    candidates moved from the first to the second, and the entries whose
+    promotion is to be finished.
+    '''
+    resumed_images = {canonical_title(entry['image']) for entry in resumed}
+    resolved = edits.preload(['File:{}'.format(entry['image']) for entry in ready_list], redirects=True,
+                             templates=['Template:VI'])
+    still_ready = []
+    already = []
+    tagged = []
+    for entry in ready_list:
+        if not edits.transcludes(resolved['File:{}'.format(entry['image'])], 'Template:VI'):
+            still_ready.append(entry)
+        elif canonical_title(entry['image']) in resumed_images:
+            logger.info('File:{} was tagged by a run which crashed, finishing its promotion'.format(entry['image']))
+            tagged.append(entry)
+        else:
+            logger.info('File:{} is already a Valued Image, only removing its nomination'.format(entry['image']))
+            already.append(entry['image'])
+    return still_ready, failed_list + already, tagged
+
+
+def promote_candidates(ready_list, edits):
+    '''
+    Tag promoted images.
+
+    The File pages were resolved and loaded by skip_already_promoted(),
+    following redirects (we can't edit a redirect page, it will fail).
+    '''
+    resolved = edits.preload(['File:{}'.format(entry['image']) for entry in ready_list], redirects=True)
     for entry in ready_list:
+        image_title = resolved['File:{}'.format(entry['image'])]
         # Mark the image as promoted
         logger.info('Promoting File:{}'.format(entry['image']))
-        image_page = pywikibot.Page(pywikibot.Site(), 'File:{}'.format(entry['image']))
-        # Issue 6: If the image page is a redirect, resolve the redirect (we can't edit the redirect page, it will fail)
-        if image_page.isRedirectPage():
-            image_page = image_page.getRedirectTarget()
-        image_page.text += '\n{{{{subst:VI-add|{}|subpage={}}}}}'.format(entry['scope'], entry['subpage'])
-        image_page.save(summary='{} promoting image to Valued Image'.format(TASK_MESSAGE))
-
-        # Add to the to-notify list
+        edits.edit(image_title, edits.get(image_title) + '\n{{{{subst:VI-add|{}|subpage={}}}}}'.format(entry['scope'], entry['subpage']),
+                   'promoting image to Valued Image')
+
+
+def save_promotions(ready_list, tagged, edits):
+    '''
+    Save the tags promote_candidates() buffered, before anything else of the promotions.
+
+    Everything else a promotion changes (the notification, the scope list,
+    the galleries, Recently promoted and the candidate list) only makes sense
+    once the image carries {{VI}}. Candidates whose tag couldn't be saved are
+    left out of all of it, so they stay on the candidate list for the next run.
+    The promotions are written down in the journal first, so the next run
+    finishes them if this one dies before it got to plan the rest.
+    tagged: entries of promotions a crashed run already tagged
+    Returns the entries of ready_list which were promoted, and tagged.
+    '''
+    edits.journal.promoting(wiki.recorder.run_id, ready_list + tagged)
+    resolved = edits.preload(['File:{}'.format(entry['image']) for entry in ready_list], redirects=True)
+    failures = edits.commit(titles=list(resolved.values()))
+    promoted = []
+    for entry in ready_list:
+        image_title = resolved['File:{}'.format(entry['image'])]
+        if image_title in failures:
+            logger.warning('File:{} could not be tagged, leaving it on the candidate list'.format(entry['image']))
+            edits.discard(image_title)
+        else:
+            promoted.append(entry)
+    return promoted + tagged
+
+
+def notify_nominators(ready_list, edits):
+    '''
+    Tell nominators about their promoted images, one message per nominator.
+
+    Notifications are posted as new sections, so User talk pages are never downloaded.
+    '''
+    user_notifications = {}
+    for entry in ready_list:
         notification = '{{{{VICpromoted|{}|{}|review={}|subpage={}}}}}'.format(entry['image'], entry['scope'], entry['review'], entry['subpage'])
         if entry['username'] in user_notifications:
             user_notifications[entry['username']] += '\n{}'.format(notification)
@@ -183,78 +778,658 @@ def promote_candidates(ready_list):
 
     for user in user_notifications:
         logger.info('Notifying User:{}'.format(user))
-        user_talk_page = pywikibot.Page(pywikibot.Site(), 'User talk:{}'.format(user))
-        text = ''
-        if user_talk_page.exists():
-            text = user_talk_page.text + '\n'
-        text = text + '==Valued Image Promoted==\n{}\n--~~~~'.format(user_notifications[user])
-        user_talk_page.text = text
-        user_talk_page.save(summary='{} notify user of promoted VI(s)'.format(TASK_MESSAGE), minor=False)
+        edits.add_section('User talk:{}'.format(user), 'Valued Image Promoted', '{}\n--~~~~'.format(user_notifications[user]),
+                          'notify user of promoted VI(s)')
+
 
+def scrub_scope(scope):
+    '''Plain text of a scope, with links, one-letter templates and bold/italics taken out.'''
+    return QUOTES_RE.sub('', LINK3_RE.sub(r'\1', LINK2_RE.sub(r'\1', scope)))
 
-def remove_candidates(candidates_to_remove):
+
+def scope_sort_key(scope):
+    return scope.replace("'", '').upper()
+
+
+def merge_scope_list(text, entries):
+    '''
+    Insert new entries into the alphabetical list of a Valued images by scope page.
+
+    The list is the block from the first to the last line matching
+    SCOPE_LIST_RE, which is assumed to be sorted already. New entries are
+    put into place by binary search and the rest of the page is left as it
+    is. Scopes already on the list are not added again.
+
+    entries: list of (image, scope) pairs, scope as given on the nomination
+    Returns the new text, which is text itself if there was nothing to insert.
+    '''
+    lines = text.split('\n')
+    positions = []
+    keys = []
+    for i, line in enumerate(lines):
+        match = SCOPE_LIST_RE.search(line)
+        if match:
+            positions.append(i)
+            keys.append(scope_sort_key(match.group(2)))
+    if not positions:
+        return text
+    present = set(keys)
+    # index into positions -> new lines to go in front of that entry (or after the last one)
+    inserts = {}
+    for image, scope in entries:
+        scrubbed = scrub_scope(scope)
+        key = scope_sort_key(scrubbed)
+        if key in present:
+            logger.debug('{} is already on the scope list'.format(scrubbed))
+            continue
+        present.add(key)
+        inserts.setdefault(bisect.bisect_right(keys, key), []).append((key, '*[[:File:{}|{}]]'.format(image, scrubbed)))
+    if not inserts:
+        return text
+    # Everything between the insertion points is copied over in one piece
+    merged = []
+    copied = 0
+    for position_index in sorted(inserts):
+        line_index = positions[position_index] if position_index < len(positions) else positions[-1] + 1
+        merged.extend(lines[copied:line_index])
+        merged.extend(line for _, line in sorted(inserts[position_index]))
+        copied = line_index
+    merged.extend(lines[copied:])
+    return '\n'.join(merged)
+
+
+def update_scope_list(ready_list, edits):
+    '''Add newly promoted images to the alphabetical list of Valued images by scope.'''
+    if not ready_list or not edits.exists(SCOPE_LIST_TITLE):
+        return
+    text = edits.get(SCOPE_LIST_TITLE)
+    new_text = merge_scope_list(text, [(entry['image'], entry['scope']) for entry in ready_list])
+    if new_text != text:
+        edits.edit(SCOPE_LIST_TITLE, new_text, 'insert into alphabetical VI list by scope')
+
+
+def tag_galleries(ready_list, edits):
+    '''
+    Mark newly promoted images with {{VI-tiny}} in the gallery their scope links to.
+
+    The gallery is the first link in the scope, or the scrubbed scope itself.
+    Galleries are resolved and loaded in batches and every gallery gets a
+    single edit for all of its images. Images which aren't found in their
+    gallery are listed on TAG_GALLERIES_TITLE, all in one edit.
+    '''
+    if not ready_list:
+        return
+    wanted = {}
+    for entry in ready_list:
+        link = LINK_RE.search(entry['scope'])
+        wanted.setdefault(link.group(1).strip() if link else scrub_scope(entry['scope']).strip(), []).append(entry)
+    # Galleries may well be redirects, resolve them all at once
+    resolved = wiki.load_pages(list(wanted), content=False, redirects=True)
+    galleries = {}
+    for title, entries in wanted.items():
+        galleries.setdefault(resolved[title]['title'], []).extend(entries)
+    edits.preload(list(galleries))
+    leftovers = []
+    for gallery_title, entries in galleries.items():
+        if not edits.exists(gallery_title):
+            logger.warning('Gallery {} does not exist'.format(gallery_title))
+            leftovers.extend(entries)
+            continue
+        images = {canonical_title(entry['image']) for entry in entries}
+        tagged = set()
+        lines = edits.get(gallery_title).split('\n')
+        for i, line in enumerate(lines):
+            gallery = GALLERY_RE.search(line)
+            if gallery is None or canonical_title(gallery.group(2)) not in images:
+                continue
+            tagged.add(canonical_title(gallery.group(2)))
+            if '{{VI-tiny}}' not in line:
+                image, _, caption = line.partition('|')
+                lines[i] = '{}|{{{{VI-tiny}}}} {}'.format(image, caption)
+        if tagged:
+            logger.info('Tagging {} images in {}'.format(len(tagged), gallery_title))
+            edits.edit(gallery_title, '\n'.join(lines), 'tag images in galleries')
+        leftovers.extend(entry for entry in entries if canonical_title(entry['image']) not in tagged)
+    if not leftovers:
+        return
+    text = edits.get(TAG_GALLERIES_TITLE)
+    if not edits.exists(TAG_GALLERIES_TITLE):
+        text = 'add <nowiki>{{VI-tiny}}</nowiki> at the gallery that matches the scope best and then remove the entry from this list\n\n'
+    text += ''.join('\n*[[:File:{}|{}]]'.format(entry['image'], scrub_scope(entry['scope'])) for entry in leftovers)
+    edits.edit(TAG_GALLERIES_TITLE, text, 'tag images in galleries')
+
+
+def canonical_title(title):
+    '''
+    Normalize a file or nomination name so different spellings of it compare equal.
+
+    Drops HTML comments and left-to-right marks, decodes HTML entities, treats
+    underscores as spaces, collapses whitespace and ignores the case of the
+    first letter.
+    '''
+    title = html.unescape(re.sub('<!--.*?-->', '', str(title), flags=re.S))
+    title = ' '.join(title.replace('\u200e', '').replace('_', ' ').split())
+    return title[:1].upper() + title[1:]
+
+
+def remove_candidates(candidates_to_remove, edits):
+    '''
+    Take promoted and failed nominations off the candidate lists.
+
+    Each list is traversed once to index its VICs entries by canonical title,
+    then all removals are applied together.
+    '''
     logger.info('Removing promoted and failed candidates')
+    to_remove = {canonical_title(candidate) for candidate in candidates_to_remove}
     for page_title in CANDIDATE_INPUT_PAGES:
-        candidate_input_page = pywikibot.Page(pywikibot.Site(), page_title)
-        parsed = mwparserfromhell.parse(candidate_input_page.text)
-        for candidate in candidates_to_remove:
-            for template in parsed.filter_templates():
-                if not template.name.matches('VICs'):
-                    continue
-                for param in template.params:
-                    if param.value.matches(candidate):
-                        if 'Most valued review candidate list' in page_title:
-                            # If we're closing out a review, delete the whole thing
-                            parsed.remove(template)
-                        else:
-                            template.params.remove(param)
-        candidate_input_page.text = parsed
-        logger.info(parsed)
-        candidate_input_page.save(summary='{} remove promoted and failed VICs'.format(TASK_MESSAGE))
-
-
-def add_recently_promoted(ready_list):
+        parsed = edits.parsed(page_title)
+        entries = {}
+        for template in parsed.filter_templates():
+            if canonical_title(template.name) != 'VICs':
+                continue
+            for param in template.params:
+                entries.setdefault(canonical_title(param.value), []).append((template, param))
+        doomed_templates = {}
+        doomed_params = {}
+        for candidate in to_remove & entries.keys():
+            for template, param in entries[candidate]:
+                if 'Most valued review candidate list' in page_title:
+                    # If we're closing out a review, delete the whole thing
+                    doomed_templates[id(template)] = template
+                else:
+                    doomed_params.setdefault(id(template), (template, set()))[1].add(id(param))
+        for template, params in doomed_params.values():
+            if id(template) not in doomed_templates:
+                template.params[:] = [param for param in template.params if id(param) not in params]
+        for template in doomed_templates.values():
+            parsed.remove(template)
+        logger.info('Removing {} entries from {}'.format(sum(len(params) for _, params in doomed_params.values()) + len(doomed_templates), page_title))
+        edits.edit(page_title, parsed, 'remove promoted and failed VICs')
+
+
+def add_recently_promoted(ready_list, edits):
+    if not ready_list:
+        return
     new_entries = ''
     for entry in ready_list:
         new_entries += 'File:{}|{}\n'.format(entry['image'], entry['scope'])
-    recently_promoted_page = pywikibot.Page(pywikibot.Site(), 'Commons:Valued images/Recently promoted')
-    recently_promoted_page.text = recently_promoted_page.text.replace('</gallery>', '{}</gallery>'.format(new_entries))
-    recently_promoted_page.save(summary='{} add recently promoted images'.format(TASK_MESSAGE))
-
-
-def move_sorted_recently_promoted():
-    recently_promoted_page = pywikibot.Page(pywikibot.Site(), 'Commons:Valued images/Recently promoted')
-    text = recently_promoted_page.text
-    for line in text.split('\n'):
-        for template in mwparserfromhell.parse(line).filter_templates():
-            if template.name == 'VICbotMove':
-                image = line.split('|')[0]
-                scope = template.get(1)
-                topic = template.get(2)
-                text = text.replace(line + '\n', '')
-                target_page = pywikibot.Page(pywikibot.Site(), 'Commons:Valued images by topic/{}'.format(topic))
-                target_page.text = target_page.text.replace('</gallery>', '{}|{}\n</gallery>'.format(image, scope))
-                target_page.save(summary='{} add sorted image'.format(TASK_MESSAGE))
-    recently_promoted_page.text = text
-    recently_promoted_page.save(summary='{} remove sorted images'.format(TASK_MESSAGE))
-
-
-def write_error_page():
-    error_page = pywikibot.Page(pywikibot.Site(), 'User:VICBot2/errors')
-    error_page.text = error_page_content
-    error_page.save(summary='{} report errors'.format(TASK_MESSAGE))
+    recently_promoted_title = RECENTLY_PROMOTED_TITLE
+    edits.edit(recently_promoted_title, edits.get(recently_promoted_title).replace('</gallery>', '{}</gallery>'.format(new_entries)),
+               'add recently promoted images')
+
+
+def move_sorted_recently_promoted(edits):
+    '''
+    Move images which have been given a topic from Recently promoted into their topic gallery.
+
+    Recently promoted is scanned once and only lines mentioning VICbotMove are
+    parsed, on parse_pool. Moves are grouped by topic, so every topic gallery
+    gets a single edit with all of its new images; images already in the
+    target gallery are not added again.
+    '''
+    recently_promoted_title = RECENTLY_PROMOTED_TITLE
+    # (line, topic it moves to or None)
+    lines = []
+    moves = {}
+    text_lines = edits.get(recently_promoted_title).split('\n')
+    marked = [line for line in text_lines if 'VICbotMove' in line]
+    # Scope and topic of each marked line, the same line always gives the same move
+    marked_moves = dict(zip(marked, parse_all(bot_moves, marked)))
+    for line in text_lines:
+        topic = None
+        if marked_moves.get(line):
+            scope, topic = marked_moves[line]
+            moves.setdefault(topic, []).append((line.split('|')[0].strip(), scope))
+        lines.append((line, topic))
+    if not moves:
+        return
+    topic_titles = {topic: '{}{}'.format(TOPIC_PREFIX, topic) for topic in moves}
+    edits.preload(list(topic_titles.values()))
+    failed_topics = set()
+    for topic, images in moves.items():
+        target_title = topic_titles[topic]
+        text = edits.get(target_title)
+        end_of_gallery = text.rfind('</gallery>')
+        if not edits.exists(target_title) or end_of_gallery < 0:
+            logger.warning('{} is missing or has no gallery, leaving its images in Recently promoted'.format(target_title))
+            errors.report('sorting recently promoted images into', 'page is missing or has no gallery', target_title)
+            failed_topics.add(topic)
+            continue
+        present = {canonical_title(line.split('|')[0]) for line in text[:end_of_gallery].split('\n')}
+        new_lines = ''
+        for image, scope in images:
+            if canonical_title(image) in present:
+                logger.debug('{} is already in {}'.format(image, target_title))
+                continue
+            present.add(canonical_title(image))
+            new_lines += '{}|{}\n'.format(image, scope)
+        if new_lines and not text[:end_of_gallery].endswith('\n'):
+            new_lines = '\n' + new_lines
+        edits.edit(target_title, text[:end_of_gallery] + new_lines + text[end_of_gallery:], 'add sorted image')
+    edits.edit(recently_promoted_title, '\n'.join(line for line, topic in lines if topic is None or topic in failed_topics),
+               'remove sorted images')
+
+
+def write_error_page(state):
+    '''
+    Save the problems of this run to the error page, unless it already lists exactly these.
+
+    state: StateStore keeping a hash of the last saved error page, so an
+    unchanged page usually doesn't even need to be read
+    '''
+    text = errors.render()
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    if state.get_meta('error_page_hash') == digest:
+        logger.debug('Error page unchanged, not saving')
+        return
+    wiki.save_page(ERROR_PAGE_TITLE, text, '{} report errors'.format(TASK_MESSAGE), only_if_changed=True)
+    state.set_meta('error_page_hash', digest)
+
+
+def vi_files(chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    All VI files on the replica, as lists of at most chunk_size (page_id, title) pairs.
+
+    Each chunk is a short query of its own, continuing after the highest page_id
+    of the previous one, so nothing is held open on the replica while the
+    caller works through a chunk.
+    '''
+    after = 0
+    while True:
+        rows = replica.query("select page_id, page_title from templatelinks, page where tl_title='VI' and tl_namespace=10 and page_namespace=6 and page_id=tl_from and page_id > %s order by page_id limit %s",
+                             (after, chunk_size))
+        if not rows:
+            return
+        yield [(page_id, page_title.replace('_', ' ')) for page_id, page_title in rows]
+        after = rows[-1][0]
+
+
+def gallery_index():
+    '''
+    Where every file is listed in the topic galleries and on the scope list.
+
+    Returns two dicts mapping canonical file names to the list of topic
+    gallery titles listing them, and to the number of scope list entries.
+    '''
+    topics = ['{}{}'.format(TOPIC_PREFIX, title.split('/', 1)[1].replace('_', ' ')) for title, in replica.query(
+        "select page_title from page where page_namespace=4 and page_title like 'Valued_images_by_topic/%'")]
+    in_topics = {}
+    for title, page in wiki.load_pages(topics).items():
+        for line in page['text'].split('\n'):
+            gallery = GALLERY_RE.search(line)
+            if gallery:
+                in_topics.setdefault(canonical_title(gallery.group(2)), []).append(title)
+    in_scope_list = {}
+    for line in wiki.load_pages([SCOPE_LIST_TITLE])[SCOPE_LIST_TITLE]['text'].split('\n'):
+        entry = SCOPE_LIST_RE.search(line)
+        if entry:
+            name = canonical_title(entry.group(1))
+            in_scope_list[name] = in_scope_list.get(name, 0) + 1
+    return in_topics, in_scope_list
+
+
+def audit(report_path=AUDIT_REPORT_PATH):
+    '''
+    Check every VI file against the topic galleries and the scope list, and write a report.
+
+    VI files are read from the replica a chunk at a time and their pages
+    fetched in batched requests. Their {{VI}} templates are parsed on
+    parse_pool while the next chunk is fetched, so at most two chunks of
+    page text are held at once.
+
+    report_path: file to write the report to, as wikitext
+    '''
+    in_topics, in_scope_list = gallery_index()
+    logger.info('Indexed {} topic gallery and {} scope list entries'.format(len(in_topics), len(in_scope_list)))
+    files = 0
+    no_template = []
+    no_scope = []
+    not_in_topics = []
+    not_in_scope_list = []
+
+    def check(names, scopes):
+        for name, scope in zip(names, scopes):
+            if scope is None:
+                no_template.append(name)
+            elif not scope:
+                no_scope.append(name)
+            if canonical_title(name) not in in_topics:
+                not_in_topics.append(name)
+            if canonical_title(name) not in in_scope_list:
+                not_in_scope_list.append(name)
+
+    previous = None
+    for chunk in vi_files():
+        names = [title for _, title in chunk]
+        pages = wiki.load_pages(['File:{}'.format(name) for name in names])
+        job = parse_pool.submit(vi_scopes, [pages['File:{}'.format(name)]['text'] for name in names])
+        if previous:
+            check(previous[0], previous[1].result())
+        previous = (names, job)
+        files += len(names)
+        logger.info('Audited {} files'.format(files))
+    if previous:
+        check(previous[0], previous[1].result())
+
+    def section(heading, lines):
+        return '== {} ({}) ==\n{}\n'.format(heading, len(lines), ''.join('* {}\n'.format(line) for line in sorted(lines)))
+
+    report = 'Audit of {} valued images, {}\n\n'.format(files, time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime()))
+    report += section('Files whose {{VI}} template has no scope', ['[[:File:{}]]'.format(name) for name in no_scope])
+    report += section('Files which no longer transclude {{VI}} directly', ['[[:File:{}]]'.format(name) for name in no_template])
+    report += section('Missing from the topic galleries', ['[[:File:{}]]'.format(name) for name in not_in_topics])
+    report += section('Missing from [[{}]]'.format(SCOPE_LIST_TITLE), ['[[:File:{}]]'.format(name) for name in not_in_scope_list])
+    report += section('Listed more than once in the topic galleries',
+                      ['[[:File:{}]]: {}'.format(name, ', '.join('[[{}]]'.format(title) for title in titles))
+                       for name, titles in in_topics.items() if len(titles) > 1])
+    report += section('Listed more than once on [[{}]]'.format(SCOPE_LIST_TITLE),
+                      ['[[:File:{}]] ({} times)'.format(name, count) for name, count in in_scope_list.items() if count > 1])
+    with open(report_path, 'w') as outfile:
+        outfile.write(report)
+    logger.info('Audit report written to {}'.format(report_path))
+
+
+def is_relevant(change):
+    '''Whether a change from the feed can affect what the bot has to do.'''
+    if change['user'] == BOT_USER:
+        return False
+    title = change['title']
+    return title.startswith(VIC_PREFIX) or title in CANDIDATE_INPUT_PAGES or title == RECENTLY_PROMOTED_TITLE
+
+
+def update_random_sample_at(state_path):
+    '''update_random_sample with the VI pool kept in the given state database.'''
+    pool = VIPool(state_path)
+    try:
+        update_random_sample(pool)
+    finally:
+        # An open write transaction would lock the state store out of the shared database
+        pool.close()
+
+
+def update_random_sample_reported(state_path):
+    '''
+    update_random_sample_at as a side stage of a run: a failure is reported on the error page instead of raised.
+
+    Nothing else in a run depends on the sample, so it shouldn't stop the run.
+    '''
+    try:
+        update_random_sample_at(state_path)
+    except Exception as error:
+        logger.exception('Could not update the random sample')
+        errors.report('updating', 'unexpected error {}: {}'.format(type(error).__name__, error), SAMPLE_TITLE)
+
+
+def refresh_sample(state_path):
+    with wiki.recorder.stage('update_random_sample'):
+        update_random_sample_at(state_path)
+
+
+async def run_stage_graph(graph):
+    '''
+    Run every stage as soon as the stages it depends on are done.
+
+    graph: dict mapping each stage name to a (function, dependencies) pair.
+    The function is called on a worker thread with the results of the stages
+    named in dependencies, in that order, so stages which don't depend on
+    each other overlap and the run takes about as long as its longest chain.
+    Returns a dict mapping each stage name to the result of its function.
+
+    A stage which raises doesn't stop the stages which don't depend on it,
+    those which do are left out. The first exception is raised once every
+    other stage is done.
+    '''
+    tasks = {}
+
+    async def run(name):
+        function, dependencies = graph[name]
+        arguments = [await tasks[dependency] for dependency in dependencies]
+
+        def staged():
+            with wiki.recorder.stage(name):
+                return function(*arguments)
+        return await asyncio.to_thread(staged)
+
+    for name in graph:
+        tasks[name] = asyncio.ensure_future(run(name))
+    # Without return_exceptions, the first failure would cancel every stage still waiting, however unrelated
+    for result in await asyncio.gather(*tasks.values(), return_exceptions=True):
+        if isinstance(result, BaseException):
+            raise result
+    return {name: task.result() for name, task in tasks.items()}
+
+
+def run_stages(state, status_backend, journal, sample_path=None):
+    '''
+    Process all candidates once and save the results.
+
+    journal: Journal the edits are written down in, edits left outstanding by earlier runs are made first
+    sample_path: state database holding the VI pool, the random sample is refreshed alongside if given
+    Returns the lists of promoted entries and of failed candidates.
+    '''
+    with wiki.recorder.stage('replay_journal'):
+        resumed = replay_journal(journal)
+    # Pages may have changed since a previous pass of the daemon
+    wiki.cache.clear()
+    edits = PendingEdits(journal)
+    # Stages which run at the same time edit different pages: File and User talk pages,
+    # the scope list, scope galleries, Recently promoted and topic galleries, candidate lists
+    graph = {
+        'find_candidate_list': (lambda: find_candidate_list(state), []),
+        'build_status_index': (lambda: build_status_index(status_backend), []),
+        'find_promotion_ready': (lambda candidate_list, status_index: find_promotion_ready(candidate_list, status_index, state),
+                                 ['find_candidate_list', 'build_status_index']),
+        'skip_already_promoted': (lambda ready: skip_already_promoted(*ready, edits, resumed=sum(resumed.values(), [])),
+                                  ['find_promotion_ready']),
+        'promote_candidates': (lambda ready: promote_candidates(ready[0], edits), ['skip_already_promoted']),
+        # The File pages are saved first, the rest only goes ahead for the candidates they were saved for
+        'save_promotions': (lambda ready, _: save_promotions(ready[0], ready[2], edits), ['skip_already_promoted', 'promote_candidates']),
+        'notify_nominators': (lambda promoted: notify_nominators(promoted, edits), ['save_promotions']),
+        'update_scope_list': (lambda promoted: update_scope_list(promoted, edits), ['save_promotions']),
+        'tag_galleries': (lambda promoted: tag_galleries(promoted, edits), ['save_promotions']),
+        # Sorting doesn't need to know what gets promoted, only to be done with Recently promoted before new entries go in
+        'move_sorted_recently_promoted': (lambda: move_sorted_recently_promoted(edits), []),
+        'add_recently_promoted': (lambda promoted, _: add_recently_promoted(promoted, edits),
+                                  ['save_promotions', 'move_sorted_recently_promoted']),
+        'remove_candidates': (lambda ready, promoted: remove_candidates(ready[1] + [x['image'] for x in promoted], edits),
+                              ['skip_already_promoted', 'save_promotions']),
+        # Nothing else was saved so far, write each page once
+        'commit': (lambda *_: edits.commit(), ['notify_nominators', 'update_scope_list', 'tag_galleries',
+                                               'add_recently_promoted', 'remove_candidates']),
+        'write_error_page': (lambda *_: write_error_page(state), ['commit']),
+    }
+    if sample_path is not None:
+        # The VI pool shares the state database, which is only free to write to once
+        # find_promotion_ready committed what it recorded in the state store
+        graph['update_random_sample'] = (lambda _: update_random_sample_reported(sample_path), ['find_promotion_ready'])
+        graph['write_error_page'][1].append('update_random_sample')
+    results = asyncio.run(run_stage_graph(graph))
+    journal.finish(wiki.recorder.run_id)
+    # The promotions crashed runs left are finished now as well
+    for run_id in resumed:
+        journal.finish(run_id)
+    errors.clear()
+    return results['save_promotions'], results['skip_already_promoted'][1]
+
+
+def report_daemon_error(state, context):
+    '''
+    Log the exception being handled and put it on the error page, for the daemon to carry on.
+
+    context: what the daemon was doing, as for ErrorCollector.report
+    '''
+    error = sys.exc_info()[1]
+    logger.exception('Unexpected error {}'.format(context))
+    errors.report(context, 'unexpected error {}: {}'.format(type(error).__name__, error))
+    try:
+        write_error_page(state)
+    except Exception:
+        logger.exception('Could not save the error page')
+    errors.clear()
+
+
+def run_daemon(feed, state, journal, state_path, status_backend, history_path, history):
+    '''
+    Keep running, processing the candidates whenever the feed shows a relevant edit.
+
+    Relevant changes are collected until a poll brings nothing new, or until
+    DAEMON_MAX_DELAY seconds passed since the first of them, and then handled
+    by a single pass over all stages. Each pass is written to the run history.
+    A pass which fails is reported on the error page and tried again
+    DAEMON_MAX_DELAY seconds later, edits it left outstanding are made first.
+    A live feed is followed until interrupted, a file feed until it runs out.
+
+    history: fields describing the mode of the run, for write_history
+    '''
+    recorder = wiki.recorder
+    pending = set()
+    first_seen = None
+    retry_at = 0
+    # Catch up on whatever happened while the bot wasn't running
+    try:
+        refresh_sample(state_path)
+    except Exception:
+        report_daemon_error(state, 'refreshing the random sample')
+    last_sample = time.monotonic()
+    pending.add(None)
+    while True:
+        relevant = {change['title'] for change in feed.poll() if is_relevant(change)}
+        now = time.monotonic()
+        if relevant:
+            logger.info('Relevant changes to {}'.format(', '.join(sorted(relevant))))
+            pending.update(relevant)
+            first_seen = first_seen or now
+        if pending and now >= retry_at and (not relevant or feed.exhausted or now - first_seen >= DAEMON_MAX_DELAY):
+            try:
+                ready_list, failed_list = run_stages(state, status_backend, journal)
+            except Exception as error:
+                report_daemon_error(state, 'processing the candidates')
+                # Keep the changes for the next pass
+                recorder.write_history(history_path, changes=len(pending - {None}), error=type(error).__name__, **history)
+                retry_at = now + DAEMON_MAX_DELAY
+            else:
+                logger.info('Cost per stage:\n{}'.format(recorder.report()))
+                recorder.write_history(history_path, changes=len(pending - {None}), promoted=len(ready_list),
+                                       removed=len(failed_list) + len(ready_list), **history)
+                pending.clear()
+                first_seen = None
+            recorder.reset()
+        if feed.exhausted:
+            return
+        if now - last_sample >= DAEMON_SAMPLE_INTERVAL:
+            try:
+                refresh_sample(state_path)
+            except Exception:
+                report_daemon_error(state, 'refreshing the random sample')
+            last_sample = now
+        time.sleep(feed.interval)
 
 
 def main():
-    pywikibot.handle_args()
-    update_random_sample()
-    candidate_list = find_candidate_list()
-    ready_list, failed_list = find_promotion_ready(candidate_list)
-    promote_candidates(ready_list)
-    add_recently_promoted(ready_list)
-    move_sorted_recently_promoted()
-    remove_candidates(failed_list + [x['image'] for x in ready_list])
-    write_error_page()
+    '''
+    Run all stages once, or keep running with -daemon.
+
+    Options besides pywikibot's own:
+    -statusbackend:sql  resolve candidate status from the replica instead of the API
+    -fullrescan         process every nomination, even unchanged ones
+    -local:<file>       run against a LocalWiki stand-in instead of Commons
+    -dryrun             print planned edits as diffs instead of saving them
+    -state:<file>       state database to use, dry and local runs default to a throwaway one
+    -history:<file>     append the run's figures to this file instead of RUN_HISTORY_PATH
+    -profile:<stage>    capture a cProfile profile of one stage
+    -tracemalloc:<stage>  capture a tracemalloc snapshot of one stage instead
+    -daemon             keep running and process the candidates whenever they are edited
+    -feed:<file>        in daemon mode, replay changes from a vicfeed.FileFeed file instead of polling Commons
+    -journal:<file>     journal of planned and made edits, dry and local runs keep none by default
+    -audit[:<file>]     check all VIs against the galleries and write a report instead of running the stages
+    -parallel[:<n>]     parse on n worker processes (one per core by default) however little there is to
+                        parse, instead of only above PARALLEL_PARSE_THRESHOLD; -parallel:0 parses in this process
+    '''
+    global wiki, replica, errors, parse_pool
+    status_backend = 'api'
+    full_rescan = False
+    local_path = None
+    dry_run = False
+    state_path = None
+    history_path = RUN_HISTORY_PATH
+    profile_stage = None
+    profile_mode = 'cprofile'
+    daemon = False
+    feed_path = None
+    journal_path = None
+    audit_path = None
+    parse_workers = None
+    parse_threshold = PARALLEL_PARSE_THRESHOLD
+    args = sys.argv[1:]
+    if not any(arg.startswith('-local:') for arg in args):
+        # pywikibot sets up the site here, which needs to reach Commons
+        args = pywikibot.handle_args(args)
+    for arg in args:
+        option, _, value = arg.partition(':')
+        if option == '-statusbackend':
+            status_backend = value
+        elif option == '-fullrescan':
+            full_rescan = True
+        elif option == '-local':
+            local_path = value
+        elif option == '-dryrun':
+            dry_run = True
+        elif option == '-state':
+            state_path = value
+        elif option == '-history':
+            history_path = value
+        elif option in ('-profile', '-tracemalloc'):
+            profile_stage = value
+            profile_mode = 'tracemalloc' if option == '-tracemalloc' else 'cprofile'
+        elif option == '-daemon':
+            daemon = True
+        elif option == '-feed':
+            feed_path = value
+        elif option == '-journal':
+            journal_path = value
+        elif option == '-audit':
+            audit_path = value or AUDIT_REPORT_PATH
+        elif option == '-parallel':
+            parse_workers = int(value) if value else None
+            parse_threshold = 0
+    if daemon and local_path and not feed_path:
+        sys.exit('A daemon on a local wiki needs -feed:<file>, the local wiki has no recent changes')
+    if state_path is None:
+        # Outcomes of a run which didn't save anything mustn't be remembered
+        state_path = ':memory:' if dry_run or local_path else STATE_DB_PATH
+    if journal_path is None and not (dry_run or local_path):
+        journal_path = JOURNAL_PATH
+    recorder = Recorder(profile_stage, profile_mode)
+    errors = ErrorCollector(recorder)
+    parse_pool = ParsePool(parse_workers, parse_threshold)
+    if local_path:
+        wiki = LocalWiki(local_path, recorder, dry_run=dry_run)
+        replica = LocalReplica(wiki, recorder)
+    else:
+        wiki = LiveWiki(recorder, dry_run=dry_run)
+        replica = Replica(recorder)
+    state = StateStore(state_path, full_rescan=full_rescan)
+    journal = Journal(journal_path)
+    history = {'mode': 'local' if local_path else 'live', 'dry_run': dry_run}
+    try:
+        if audit_path:
+            with recorder.stage('audit'):
+                audit(audit_path)
+            history['mode'] += '-audit'
+        elif daemon:
+            feed = FileFeed(feed_path) if feed_path else RecentChangesFeed(wiki, namespaces=[4], interval=DAEMON_POLL_INTERVAL)
+            run_daemon(feed, state, journal, state_path, status_backend, history_path, dict(history, mode=history['mode'] + '-daemon'))
+            return
+        else:
+            ready_list, failed_list = run_stages(state, status_backend, journal, sample_path=state_path)
+            history.update(promoted=len(ready_list), removed=len(failed_list) + len(ready_list))
+    finally:
+        state.close()
+        replica.close()
+        wiki.close()
+        parse_pool.close()
+    logger.info('Cost per stage:\n{}'.format(recorder.report()))
+    recorder.write_history(history_path, **history)
 
 
 if __name__ == '__main__':
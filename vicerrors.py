@@ -0,0 +1,74 @@
+'''Problems VICBot2 runs into, collected for its error page.'''
+import json
+import threading
+
+from vicstats import Recorder
+
+# Namespaces whose pages must be linked with a leading colon, or the link would embed or categorize
+COLON_NAMESPACES = ('File:', 'Image:', 'Category:')
+
+
+def page_link(page):
+    return '[[:{}]]'.format(page) if page.startswith(COLON_NAMESPACES) else '[[{}]]'.format(page)
+
+
+class ErrorCollector:
+    '''
+    Problems of a run, each recorded with its stage, the page it concerns and its kind.
+
+    The same problem reported twice is kept once, and render() lists the
+    problems in a fixed order, so a run running into the same problems as the
+    last one produces the same error page text. Stages may report from any thread.
+
+    recorder: vicstats.Recorder telling which stage is reporting
+    '''
+
+    def __init__(self, recorder=None):
+        self.recorder = recorder or Recorder()
+        # (stage, context, page, kind)
+        self.entries = set()
+        self.lock = threading.Lock()
+
+    def report(self, context, kind, page=None):
+        '''
+        Record a problem.
+
+        context: what the bot was doing, such as 'saving' or 'candidate evaluation for'
+        kind: what went wrong
+        page: title of the page the problem concerns, if any
+        '''
+        with self.lock:
+            self.entries.add((self.recorder.current_stage, context, page or '', kind))
+
+    @staticmethod
+    def encode(context, kind, page=None):
+        '''
+        A problem as a string for storing it across runs, such as a StateStore outcome.
+
+        The string starts with '* ', which no discussion status does.
+        '''
+        return '* ' + json.dumps([context, kind, page])
+
+    def report_encoded(self, stored):
+        '''
+        Record a problem stored with encode() again.
+
+        Returns False if stored isn't such a problem, for instance because it was written by an older version.
+        '''
+        try:
+            context, kind, page = json.loads(stored[2:])
+        except ValueError:
+            return False
+        self.report(context, kind, page)
+        return True
+
+    def render(self):
+        '''Wikitext listing every problem, one line each, sorted by stage, context, page and kind.'''
+        lines = []
+        for _, context, page, kind in sorted(self.entries):
+            lines.append('* In {}{}: {}\n'.format(context, ' ' + page_link(page) if page else '', kind))
+        return ''.join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
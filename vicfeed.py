@@ -0,0 +1,80 @@
+'''
+Change feeds for the VICBot2 daemon.
+
+A feed is polled repeatedly, each poll returns the changes which happened
+since the previous one as dicts with at least the keys 'title' and 'user'.
+RecentChangesFeed follows the wiki's recent changes, FileFeed replays
+changes recorded in a file.
+'''
+import datetime
+import json
+
+from loguru import logger
+
+
+class RecentChangesFeed:
+    '''
+    Polls the recent changes of a wiki.
+
+    wiki: vicwiki.Wiki backend with a recent changes feed
+    namespaces: list of namespace numbers to follow, all namespaces if None
+    interval: seconds to wait between two polls
+    since: ISO 8601 timestamp to start from, now if None
+    '''
+    # Live feeds never run out
+    exhausted = False
+
+    def __init__(self, wiki, namespaces=None, interval=10, since=None):
+        self.wiki = wiki
+        self.interval = interval
+        self.namespaces = namespaces
+        self.since = since or datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        # Changes at exactly self.since, which the next poll returns again
+        self.seen = set()
+
+    def poll(self):
+        changes = [change for change in self.wiki.recent_changes(self.since, self.namespaces)
+                   if change['rcid'] not in self.seen]
+        if changes:
+            latest = changes[-1]['timestamp']
+            if latest != self.since:
+                self.since = latest
+                self.seen = set()
+            self.seen.update(change['rcid'] for change in changes if change['timestamp'] == latest)
+        return changes
+
+
+class FileFeed:
+    '''
+    Replays changes from a file, for tests and for reprocessing past events.
+
+    The file holds one JSON change per line, such as
+        {"title": "Commons:Valued image candidates/Example.jpg", "user": "Example"}
+    Blank lines separate polls, so an empty poll can be written as two
+    blank lines in a row. The feed is exhausted after the last line.
+
+    path: location of the file
+    '''
+    # Replayed polls follow each other without waiting
+    interval = 0
+
+    def __init__(self, path):
+        self.polls = []
+        poll = []
+        with open(path) as infile:
+            for line in infile:
+                if line.strip():
+                    poll.append(json.loads(line))
+                else:
+                    self.polls.append(poll)
+                    poll = []
+        if poll:
+            self.polls.append(poll)
+        logger.debug('Replaying {} polls from {}'.format(len(self.polls), path))
+
+    @property
+    def exhausted(self):
+        return not self.polls
+
+    def poll(self):
+        return self.polls.pop(0) if self.polls else []
@@ -0,0 +1,323 @@
+'''
+Reading templates off pages for VICBot2.
+
+extract_nomination() only tokenizes the {{VIC}} invocation of a nomination
+page, which is much cheaper than building a parse tree of the whole
+discussion. Pages it can't be sure about are left to nomination_from_tree(),
+which gives the same results the bot always got.
+
+Full parses of many pages can be spread over worker processes with a
+ParsePool. Its parse functions live here rather than in vicbot2, so they
+don't depend on the bot's state. Workers still import the main module of
+the process before anything else, like any multiprocessing worker started
+without fork, which for the bot means vicbot2 and pywikibot.
+'''
+import concurrent.futures
+import multiprocessing
+import os
+import re
+import threading
+from typing import NamedTuple
+
+import mwparserfromhell
+from mwparserfromhell.definitions import PARSER_BLACKLIST
+
+# There are two template starts between the noinclude/includeonly, the second one is dropped
+VIC_THUMB_HACK = '<includeonly>{{VIC-thumb</includeonly>'
+NOINCLUDE_RE = re.compile(r'</?noinclude>', re.I)
+# Start of the first {{VIC}} invocation (not {{VICs}} or {{VIC-thumb}}), with the name matched like Wikicode.matches() does
+VIC_START_RE = re.compile(r'\{\{\s*[Vv]IC(?=(?:\s|(?i:</?noinclude>)|' + re.escape(VIC_THUMB_HACK) + r')*(?:\||\}\}))')
+# Names of templates before the one VIC_START_RE found, which might still be VIC once comments and tags are taken out
+EARLIER_NAME_RE = re.compile(r'\{\{([^{}|]*)')
+MARKUP_RE = re.compile(r'<!--.*?(?:-->|\Z)|<[^<>]*>', re.S)
+COMMENT_RE = re.compile(r'<!--.*?-->', re.S)
+# Tags such as nowiki, pre and gallery whose contents mwparserfromhell takes as plain text
+VERBATIM_TAG_RE = re.compile(r'<(?P<closing>/?)(?P<name>{})\b[^<>]*?(?P<self_closing>/?)>'.format('|'.join(PARSER_BLACKLIST)), re.I)
+# Everything inside a template that matters for finding its parameters. Comments and
+# nowiki are taken whole, HTML tags are matched up with their closing tag separately.
+TOKEN_RE = re.compile(r'(?P<verbatim><!--.*?(?:-->|\Z)|(?i:<nowiki\s*>.*?</nowiki\s*>))'
+                      r'|(?P<dropped>(?i:</?noinclude>)|' + re.escape(VIC_THUMB_HACK) + r')'
+                      r'|(?P<bracket>\{\{\{|\}\}\}|\{\{|\}\}|\[\[|\]\]|\||=)'
+                      r'|(?P<tag><(?P<closing>/?)(?P<name>[A-Za-z][\w-]*)[^<>]*?(?P<self_closing>/?)>)',
+                      re.S)
+# Tags which never have a closing tag
+VOID_TAGS = {'br', 'hr', 'img', 'wbr'}
+# Characters of text a ParsePool parses in this process before worker processes pay off. Parsing
+# takes about 2us a character, a worker importing vicbot2 and pywikibot about 0.4s before it starts
+PARALLEL_PARSE_THRESHOLD = 512 * 1024
+# Most texts handed to a worker process at a time
+PARSE_BATCH = 100
+
+
+class Nomination(NamedTuple):
+    '''Parameters of a {{VIC}} template, '' where a parameter is missing.'''
+    image: str = ''
+    scope: str = ''
+    nominator: str = ''
+    subpage: str = ''
+    review: str = ''
+
+
+def normalize_nomination(text):
+    '''Nomination text with the noinclude/includeonly trickery taken out, as mwparserfromhell needs it.'''
+    return NOINCLUDE_RE.sub('', text).replace(VIC_THUMB_HACK, '')
+
+
+def nomination_from_params(params):
+    '''
+    params: dict mapping stripped parameter names to their values
+    '''
+    def value(name):
+        return params.get(name, '').strip()
+    return Nomination(value('image').replace('_', ' '), value('scope'), value('nominator'), value('subpage'), value('review'))
+
+
+def verbatim_tag(text):
+    '''Name of the nowiki, pre or similar tag left open at the end of text, None if there is none.'''
+    open_tag = None
+    for tag in VERBATIM_TAG_RE.finditer(COMMENT_RE.sub('', text)):
+        name = tag.group('name').lower()
+        if open_tag is None and not tag.group('closing') and not tag.group('self_closing'):
+            open_tag = name
+        elif open_tag == name and tag.group('closing'):
+            open_tag = None
+    return open_tag
+
+
+def extract_nomination(text):
+    '''
+    Read the first {{VIC}} template of a nomination page without parsing the page.
+
+    Braces of nested templates, links, comments, nowiki and HTML tags are
+    tracked so only pipes and equals signs of the template itself count.
+    A pipe or end of the template after an unclosed single bracket, such as
+    the start of an external link, is left to the parser.
+    When a parameter is given twice the last one wins.
+    Returns a Nomination, or None if the template wasn't found or the
+    extractor can't be sure it reads it the way mwparserfromhell would.
+    '''
+    start = VIC_START_RE.search(text)
+    if start is None:
+        return None
+    # What the parser sees before the template
+    before = normalize_nomination(text[:start.start()])
+    if before.endswith('{'):
+        # Part of a longer run of braces
+        return None
+    for earlier in EARLIER_NAME_RE.finditer(before):
+        name = MARKUP_RE.sub('', earlier.group(1)).strip()
+        if name in ('VIC', 'vIC') or '<' in earlier.group(1) and re.match(r'[Vv]IC(?![\w-])', name):
+            # Maybe an earlier {{VIC}} written unusually
+            return None
+    comment = before.rfind('<!--')
+    if comment != -1 and before.find('-->', comment + 4) == -1 or verbatim_tag(before):
+        # The first candidate is commented out or shown as text, leave it to the parser
+        return None
+    if before.rfind('[[') > before.rfind(']]'):
+        # Inside a link, which the parser may or may not close
+        return None
+    params = {}
+    # Pieces of the current parameter: its name once an equals sign was seen, and its value
+    name = None
+    value = []
+    braces = 0
+    links = 0
+    position = start.end()
+    while True:
+        token = TOKEN_RE.search(text, position)
+        if token is None:
+            # The template is never closed
+            return None
+        value.append(text[position:token.start()])
+        position = token.end()
+        piece = token.group(0)
+        if token.lastgroup == 'verbatim':
+            value.append(normalize_nomination(piece))
+        elif token.lastgroup == 'dropped':
+            continue
+        elif token.lastgroup == 'tag':
+            closing, tag, self_closing = token.group('closing'), token.group('name').lower(), token.group('self_closing')
+            if closing:
+                # A closing tag which wasn't opened inside the template
+                return None
+            if not (self_closing or tag in VOID_TAGS):
+                # Pipes inside a tag don't separate parameters, take it up to its closing tag
+                end = re.compile(r'</{}\s*>'.format(re.escape(tag)), re.I).search(text, position)
+                if end is None or re.search(r'<{}\b'.format(re.escape(tag)), text[position:end.start()], re.I):
+                    # Unclosed, or nested in a tag of the same name
+                    return None
+                piece = normalize_nomination(text[token.start():end.end()])
+                body = text[position:end.start()].lower()
+                if '<!--' in body or verbatim_tag(body) or '{{{' in piece or '}}}' in piece or \
+                        piece.count('{{') != piece.count('}}') or piece.count('[[') != piece.count(']]'):
+                    # Markup crossing the tag boundary, the parser may not read it as a tag
+                    return None
+                position = end.end()
+            value.append(piece)
+        elif piece == '|' and text[token.start() - 1:token.start()] == '{':
+            # Start of a table, whose pipes the parser keeps inside the parameter
+            return None
+        elif piece in ('{{{', '}}}'):
+            # Runs of three braces make brace counting ambiguous
+            return None
+        elif piece == '{{':
+            braces += 1
+            value.append(piece)
+        elif piece == '}}' and braces:
+            braces -= 1
+            value.append(piece)
+        elif piece == '[[':
+            links += 1
+            value.append(piece)
+        elif piece == ']]':
+            links = max(links - 1, 0)
+            value.append(piece)
+        elif piece == '=':
+            if name is None and not braces and not links:
+                name = ''.join(value)
+                if '{{' in name or '[' in name or '<' in name:
+                    # The parser may not take markup in a parameter name
+                    return None
+                value = []
+            else:
+                value.append(piece)
+        elif braces or links:
+            if piece == '}}':
+                # The template ends inside a link which is never closed
+                return None
+            value.append(piece)
+        else:
+            # '|' or '}}' of the template itself
+            single = ''.join(value).replace('[[', '').replace(']]', '')
+            if single.rfind('[') > single.rfind(']'):
+                # Maybe inside an external link such as [http://example.org a|b], which keeps its pipes
+                return None
+            if name is not None:
+                params[name.strip()] = ''.join(value)
+            name = None
+            value = []
+            if piece == '}}':
+                return nomination_from_params(params)
+
+
+def nomination_from_tree(text, parse=mwparserfromhell.parse):
+    '''Read the first {{VIC}} template from a full parse of the page, None if there is none.'''
+    for template in parse(normalize_nomination(text)).filter_templates():
+        if template.name.matches('VIC'):
+            params = {}
+            for param in template.params:
+                params[str(param.name).strip()] = str(param.value)
+            return nomination_from_params(params)
+    return None
+
+
+def nominations_from_trees(texts):
+    '''nomination_from_tree for each of a list of nomination page texts, for a ParsePool.'''
+    return [nomination_from_tree(text) for text in texts]
+
+
+def vi_scopes(texts):
+    '''
+    Scope of the {{VI}} template on each of a list of file page texts, for a ParsePool.
+
+    Gives '' for a template without a scope and None for a page without the template.
+    '''
+    scopes = []
+    for text in texts:
+        scope = None
+        for template in mwparserfromhell.parse(text).filter_templates():
+            if template.name.strip().upper() == 'VI':
+                scope = str(template.get(1).value).strip() if template.has(1) else ''
+                break
+        scopes.append(scope)
+    return scopes
+
+
+def bot_moves(lines):
+    '''
+    Scope and topic of the {{VICbotMove}} template on each of a list of gallery lines, for a ParsePool.
+
+    Gives None for a line without a complete template.
+    '''
+    moves = []
+    for line in lines:
+        move = None
+        for template in mwparserfromhell.parse(line).filter_templates():
+            if template.name.matches('VICbotMove') and template.has(1) and template.has(2):
+                move = (str(template.get(1).value).strip(), str(template.get(2).value).strip())
+                break
+        moves.append(move)
+    return moves
+
+
+class ParseJob:
+    '''Texts handed to a ParsePool, see ParsePool.submit.'''
+
+    def __init__(self, futures):
+        self.futures = futures
+
+    def result(self):
+        '''Wait for the results, returns them in the order of the texts.'''
+        return [result for future in self.futures for result in future.result()]
+
+
+class ParsePool:
+    '''
+    Applies parse functions to lists of texts, on worker processes when that pays off.
+
+    Every worker imports the main module before it parses anything, for the
+    bot that costs as much as parsing some fifty nominations. So
+    texts are parsed in this process unless there are more than threshold
+    characters of them and more than one worker. Either way the results come
+    back in the order of the texts. The workers are started on first use and
+    shared by every stage of a run, stages may use the pool from different threads.
+
+    workers: number of worker processes, one per core if None, 0 to parse everything in this process
+    threshold: characters of text above which workers are used, 0 to use them for any amount of text
+    '''
+
+    def __init__(self, workers=None, threshold=PARALLEL_PARSE_THRESHOLD):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.threshold = threshold
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def parallel(self, texts):
+        '''Whether texts are worth sending to the worker processes.'''
+        if not self.workers or not texts:
+            return False
+        if not self.threshold:
+            return True
+        return self.workers > 1 and sum(len(text) for text in texts) > self.threshold
+
+    def submit(self, function, texts):
+        '''
+        Start applying a parse function to texts.
+
+        function: module-level function taking a list of texts and returning a list with a result for each
+        Returns a ParseJob. Texts which aren't worth sending to the workers
+        are parsed right away, so only the results of the workers are waited for.
+        '''
+        texts = list(texts)
+        if not self.parallel(texts):
+            parsed = concurrent.futures.Future()
+            parsed.set_result(function(texts))
+            return ParseJob([parsed])
+        with self.lock:
+            if self.executor is None:
+                # Forking a process which runs threads can copy a lock some other thread holds into the worker
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                                       mp_context=multiprocessing.get_context('forkserver'))
+        # Several batches per worker, so a batch of long pages doesn't hold up the rest
+        size = max(1, min(PARSE_BATCH, -(-len(texts) // (self.workers * 4))))
+        return ParseJob([self.executor.submit(function, texts[i:i + size]) for i in range(0, len(texts), size)])
+
+    def map(self, function, texts):
+        '''Apply a parse function to texts, returns the results in the order of the texts.'''
+        return self.submit(function, texts).result()
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
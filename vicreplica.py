@@ -0,0 +1,173 @@
+'''
+Replica database access for VICBot2.
+
+Replica queries the Commons replica on Toolforge, LocalReplica answers the
+same queries from the pages of a LocalWiki. All SQL the bot runs goes
+through one of them. Rows come back with all byte strings decoded, and
+errors from either backend are raised as ReplicaError.
+'''
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+from vicwiki import namespace_of
+
+# Attempts per query on OperationalError, waiting REPLICA_BACKOFF seconds
+# after the first failure and twice as long after each further one
+REPLICA_ATTEMPTS = 4
+REPLICA_BACKOFF = 2
+STREAM_CHUNK_SIZE = 1000
+
+
+class ReplicaError(Exception):
+    '''The replica could not be reached or the query failed.'''
+
+
+def decode_row(row):
+    return tuple(value.decode() if isinstance(value, bytes) else value for value in row)
+
+
+class Replica:
+    '''
+    The commonswiki_p replica.
+
+    The connection is opened on first use and reused for the rest of the run;
+    when it breaks it is reopened and the query retried with backoff. Queries
+    are parameterized with %s placeholders, MySQLdb escapes the arguments.
+
+    recorder: vicstats.Recorder which counts and times the queries
+    '''
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.connection = None
+        # MySQLdb connections mustn't be shared between threads
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # Only imported here so offline runs work without mysqlclient
+        import MySQLdb
+        return MySQLdb.connect(host='commonswiki.labsdb', db='commonswiki_p', read_default_file='~/replica.my.cnf')
+
+    def _reset(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+
+    def _retrying(self, action):
+        '''Run action(connection), reconnecting and retrying on OperationalError.'''
+        import MySQLdb
+        for attempt in range(REPLICA_ATTEMPTS):
+            try:
+                if self.connection is None:
+                    self.connection = self.connect()
+                return action(self.connection)
+            except MySQLdb.OperationalError as error:
+                self._reset()
+                if attempt == REPLICA_ATTEMPTS - 1:
+                    raise ReplicaError(error) from error
+                delay = REPLICA_BACKOFF * 2 ** attempt
+                logger.warning('MySQL Error {}, retrying in {} seconds'.format(error, delay))
+                time.sleep(delay)
+
+    def query(self, sql, args=()):
+        '''
+        Run a query, parameters use the %s placeholder.
+
+        Returns all rows as a list of tuples.
+        '''
+        def run(connection):
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql, args)
+                return [decode_row(row) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+
+        with self.lock, self.recorder.record('sql'):
+            return self._retrying(run)
+
+    def stream(self, sql, args=(), chunk_size=STREAM_CHUNK_SIZE):
+        '''
+        Run a query with a server-side cursor and yield its rows in lists of up to chunk_size.
+
+        Only the current chunk is held in memory. Streams use a connection of
+        their own, so other queries can run while one is being consumed.
+        Retries only happen before the first chunk is delivered.
+        '''
+        import MySQLdb
+        import MySQLdb.cursors
+        stream_replica = Replica(self.recorder)
+
+        def start(connection):
+            cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+            cursor.execute(sql, args)
+            return cursor
+
+        with self.recorder.record('sql'):
+            cursor = stream_replica._retrying(start)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [decode_row(row) for row in rows]
+        except MySQLdb.OperationalError as error:
+            raise ReplicaError(error) from error
+        finally:
+            cursor.close()
+            stream_replica.close()
+
+    def close(self):
+        with self.lock:
+            self._reset()
+
+
+class LocalReplica(Replica):
+    '''
+    In-memory SQLite stand-in for the replica.
+
+    The page, templatelinks and categorylinks tables are filled from the pages
+    of a LocalWiki, with the columns the bot's queries use. MySQL-only syntax
+    isn't translated apart from the %s placeholders.
+    '''
+
+    def __init__(self, wiki, recorder):
+        super().__init__(recorder)
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.connection.execute('create table page (page_id integer primary key, page_namespace integer, page_title text)')
+        self.connection.execute('create table templatelinks (tl_from integer, tl_namespace integer, tl_title text)')
+        self.connection.execute('create table categorylinks (cl_from integer, cl_to text)')
+        for title, page in wiki.pages.items():
+            namespace = namespace_of(title)
+            name = title.split(':', 1)[1] if namespace else title
+            self.connection.execute('insert into page values (?, ?, ?)', (page['page_id'], namespace, name.replace(' ', '_')))
+            for template in page.get('templates', []):
+                self.connection.execute('insert into templatelinks values (?, 10, ?)', (page['page_id'], template.split(':', 1)[1].replace(' ', '_')))
+            for category in page.get('categories', []):
+                self.connection.execute('insert into categorylinks values (?, ?)', (page['page_id'], category.split(':', 1)[1].replace(' ', '_')))
+
+    def query(self, sql, args=()):
+        with self.lock, self.recorder.record('sql'):
+            try:
+                return [decode_row(row) for row in self.connection.execute(sql.replace('%s', '?'), tuple(args)).fetchall()]
+            except sqlite3.Error as error:
+                raise ReplicaError(error) from error
+
+    def stream(self, sql, args=(), chunk_size=STREAM_CHUNK_SIZE):
+        with self.recorder.record('sql'):
+            try:
+                with self.lock:
+                    rows = self.connection.execute(sql.replace('%s', '?'), tuple(args)).fetchall()
+            except sqlite3.Error as error:
+                raise ReplicaError(error) from error
+        for i in range(0, len(rows), chunk_size):
+            yield [decode_row(row) for row in rows[i:i + chunk_size]]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,268 @@
+'''Persistent state VICBot2 keeps between runs.'''
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+STATE_DB_PATH = os.path.expanduser('~/vicbot2.sqlite3')
+JOURNAL_PATH = os.path.expanduser('~/vicbot2-journal.jsonl')
+
+
+class StateStore:
+    '''
+    SQLite-backed record of the last-seen revid and decided outcome for each page.
+
+    path: location of the database file, normally in the tool's home directory
+    full_rescan: ignore everything stored so far (new results are still recorded)
+    Stages may use the store from different threads, one at a time.
+    '''
+
+    def __init__(self, path=STATE_DB_PATH, full_rescan=False):
+        self.full_rescan = full_rescan
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute('create table if not exists pages (title text primary key, revid integer, outcome text)')
+        self.connection.execute('create table if not exists meta (key text primary key, value text)')
+        self.connection.commit()
+
+    def lookup(self, title, revid):
+        '''
+        Get the outcome stored for a page, as long as it hasn't been edited since.
+
+        Returns None if the page is unknown, its revid moved or a full rescan was requested.
+        '''
+        if self.full_rescan or revid is None:
+            return None
+        with self.lock:
+            row = self.connection.execute('select outcome from pages where title=? and revid=?', (title, revid)).fetchone()
+        return row[0] if row else None
+
+    def record(self, title, revid, outcome):
+        '''Remember the outcome decided for a page at the given revid.'''
+        with self.lock:
+            self.connection.execute('insert or replace into pages (title, revid, outcome) values (?, ?, ?)', (title, revid, outcome))
+
+    def evict(self, keep):
+        '''
+        Drop every page which is not in keep.
+
+        keep: titles which are still listed and worth tracking
+        '''
+        keep = set(keep)
+        with self.lock:
+            stale = [(row[0],) for row in self.connection.execute('select title from pages') if row[0] not in keep]
+            self.connection.executemany('delete from pages where title=?', stale)
+            self.connection.commit()
+        return len(stale)
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute('select value from meta where key=?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.connection.execute('insert or replace into meta (key, value) values (?, ?)', (key, str(value)))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class VIPool:
+    '''
+    Locally cached pool of valued image titles and their scopes.
+
+    Entries live in dense slots 0..n-1, so picking a random entry is a single
+    indexed lookup no matter how large the pool is. Removing an entry moves the
+    last one into its slot.
+
+    path: location of the database file, shared with StateStore
+    '''
+
+    def __init__(self, path=STATE_DB_PATH):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('create table if not exists vi_pool (slot integer primary key, page_id integer unique, title text, scope text)')
+        self.connection.execute('create table if not exists meta (key text primary key, value text)')
+        self.connection.commit()
+
+    def size(self):
+        # Slots are dense, so this is an index lookup rather than a count over the table
+        return self.connection.execute('select coalesce(max(slot) + 1, 0) from vi_pool').fetchone()[0]
+
+    def max_page_id(self):
+        return self.connection.execute('select coalesce(max(page_id), 0) from vi_pool').fetchone()[0]
+
+    def add(self, page_id, title):
+        '''Add a file to the pool, or update its title if it is already there.'''
+        if self.connection.execute('update vi_pool set title=? where page_id=?', (title, page_id)).rowcount:
+            return
+        self.connection.execute('insert into vi_pool (slot, page_id, title) values (?, ?, ?)', (self.size(), page_id, title))
+
+    def remove(self, page_id):
+        row = self.connection.execute('select slot from vi_pool where page_id=?', (page_id,)).fetchone()
+        if not row:
+            return
+        last = self.size() - 1
+        self.connection.execute('delete from vi_pool where page_id=?', (page_id,))
+        if row[0] != last:
+            self.connection.execute('update vi_pool set slot=? where slot=?', (row[0], last))
+
+    def sync(self, entries):
+        '''
+        Make the pool contain exactly the given files.
+
+        entries: iterable of (page_id, title) pairs
+        Scopes already known for files which stay in the pool are kept.
+        '''
+        seen = set()
+        for page_id, title in entries:
+            seen.add(page_id)
+            self.add(page_id, title)
+        for (page_id,) in self.connection.execute('select page_id from vi_pool').fetchall():
+            if page_id not in seen:
+                self.remove(page_id)
+        self.set_meta('last_full_refresh', time.time())
+
+    def set_scope(self, page_id, scope):
+        self.connection.execute('update vi_pool set scope=? where page_id=?', (scope, page_id))
+
+    def sample(self, count):
+        '''
+        Pick up to count distinct entries at random.
+
+        Returns a list of (page_id, title, scope) tuples, scope is None if it isn't known yet.
+        '''
+        slots = random.sample(range(self.size()), min(count, self.size()))
+        return [self.connection.execute('select page_id, title, scope from vi_pool where slot=?', (slot,)).fetchone()
+                for slot in slots]
+
+    def get_meta(self, key, default=None):
+        row = self.connection.execute('select value from meta where key=?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.connection.execute('insert or replace into meta (key, value) values (?, ?)', (key, str(value)))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class Journal:
+    '''
+    Append-only record of the edits each run is about to make and has made.
+
+    Every edit is written down as planned before it is attempted and marked
+    done once it went through, and a run marks itself finished at the very
+    end. Planned edits of a run which never finished that aren't marked done
+    are what a crash left outstanding. The file is emptied as soon as every
+    run in it has finished.
+
+    Promotions are written down before their File: pages are tagged, as
+    their other edits are only worked out afterwards. A run whose last edits
+    were never planned leaves its promotions to be finished by the next run.
+
+    path: location of the journal file, None to keep no journal
+    '''
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _append(self, entries):
+        if self.path is None:
+            return
+        lines = ''.join(json.dumps(entry, sort_keys=True) + '\n' for entry in entries).encode()
+        with self.lock, open(self.path, 'a+b') as outfile:
+            if outfile.seek(0, os.SEEK_END) and (outfile.seek(-1, os.SEEK_END), outfile.read(1))[1] != b'\n':
+                # Starts past the half written line a crash left
+                lines = b'\n' + lines
+            outfile.write(lines)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def _read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path) as infile:
+            for line in infile:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A crash can leave a line half written
+                    continue
+        return entries
+
+    def plan(self, run_id, edits, last=False):
+        '''
+        Write down edits before they are attempted.
+
+        edits: list of dicts with the keyword arguments for Wiki.save_page, including 'title' and 'baserevid'
+        last: these are the last edits of the run, its promotions need nothing else
+        '''
+        entries = [dict(edit, run=run_id, event='planned') for edit in edits]
+        if last:
+            # Written after the edits, so it is only read back if all of them are
+            entries.append({'run': run_id, 'event': 'planned all'})
+        self._append(entries)
+
+    def promoting(self, run_id, entries):
+        '''
+        Write down promotions before their File: pages are tagged.
+
+        entries: list of JSON-serializable promotion entries
+        '''
+        self._append([{'run': run_id, 'event': 'promoting', 'entries': entries}])
+
+    def done(self, run_id, title, baserevid):
+        self._append([{'run': run_id, 'event': 'done', 'title': title, 'baserevid': baserevid}])
+
+    def finish(self, run_id):
+        '''Mark a run as finished, and empty the journal if no run in it is unfinished any more.'''
+        self._append([{'run': run_id, 'event': 'finished'}])
+        if self.path is None:
+            return
+        with self.lock:
+            entries = self._read()
+            if {entry['run'] for entry in entries} <= {entry['run'] for entry in entries if entry['event'] == 'finished'}:
+                open(self.path, 'w').close()
+
+    def outstanding(self):
+        '''
+        Edits which unfinished runs planned but never got done.
+
+        Returns a dict mapping the run id of each unfinished run to the list of
+        its outstanding edits as given to plan(), in the order they were planned.
+        '''
+        entries = self._read()
+        finished = {entry['run'] for entry in entries if entry['event'] == 'finished'}
+        done = {(entry['run'], entry['title'], entry['baserevid']) for entry in entries if entry['event'] == 'done'}
+        runs = {}
+        for entry in entries:
+            if entry['event'] != 'planned' or entry['run'] in finished:
+                continue
+            runs.setdefault(entry['run'], [])
+            if (entry['run'], entry['title'], entry['baserevid']) not in done:
+                runs[entry['run']].append({key: value for key, value in entry.items() if key not in ('run', 'event')})
+        return runs
+
+    def unfinished_promotions(self):
+        '''
+        Promotions of unfinished runs which never got to plan their last edits.
+
+        Returns a dict mapping the run id of each such run to its promotion
+        entries as given to promoting(), in the order they were written down.
+        '''
+        entries = self._read()
+        settled = {entry['run'] for entry in entries if entry['event'] in ('finished', 'planned all')}
+        runs = {}
+        for entry in entries:
+            if entry['event'] == 'promoting' and entry['run'] not in settled:
+                runs.setdefault(entry['run'], []).extend(entry['entries'])
+        return runs
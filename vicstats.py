@@ -0,0 +1,148 @@
+'''Per-stage instrumentation of VICBot2 runs.'''
+import contextlib
+import contextvars
+import cProfile
+import datetime
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+import uuid
+
+from loguru import logger
+
+RUN_HISTORY_PATH = os.path.expanduser('~/vicbot2-runs.jsonl')
+PROFILE_DIR = os.path.expanduser('~')
+
+
+class Recorder:
+    '''
+    Collects what each stage of a run costs.
+
+    Per stage this is the wall time, the bytes downloaded and uploaded (and
+    those a partial fetch saved downloading, 'bytes_saved'), and the
+    count and total seconds of each kind of request ('read', 'write', 'sql')
+    and of wikitext parses ('parse'). Requests are attributed to the stage
+    entered last in the current context, so stages running side by side on
+    different threads are kept apart. Work handed to other threads counts
+    towards the stage that started it as long as the context is copied along
+    (asyncio.to_thread does this, executors need contextvars.copy_context()).
+
+    profile_stage: name of a stage to capture a profile of
+    profile_mode: 'cprofile' or 'tracemalloc'
+    '''
+
+    def __init__(self, profile_stage=None, profile_mode='cprofile'):
+        self.profile_stage = profile_stage
+        self.profile_mode = profile_mode
+        self._current_stage = contextvars.ContextVar('current_stage', default='setup')
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Start over with a new run id, for the next pass of a long-running daemon.'''
+        with self.lock:
+            self.run_id = uuid.uuid4().hex
+            self.started = datetime.datetime.now(datetime.timezone.utc)
+            self.stats = {}
+
+    @property
+    def current_stage(self):
+        return self._current_stage.get()
+
+    def _stage_stats(self, stage):
+        return self.stats.setdefault(stage, {'wall_seconds': 0.0, 'bytes_down': 0, 'bytes_up': 0})
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        token = self._current_stage.set(name)
+        start = time.monotonic()
+        try:
+            if name == self.profile_stage:
+                with self.profile(name):
+                    yield
+            else:
+                yield
+        finally:
+            with self.lock:
+                self._stage_stats(name)['wall_seconds'] += time.monotonic() - start
+            self._current_stage.reset(token)
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        '''Capture a cProfile or tracemalloc snapshot of one stage and save it next to the run history.'''
+        if self.profile_mode == 'tracemalloc':
+            tracemalloc.start()
+            try:
+                yield
+                snapshot = tracemalloc.take_snapshot()
+            finally:
+                tracemalloc.stop()
+            path = os.path.join(PROFILE_DIR, 'vicbot2-{}.tracemalloc'.format(name))
+            snapshot.dump(path)
+            top = '\n'.join(str(stat) for stat in snapshot.statistics('lineno')[:15])
+            logger.info('Top allocations in {} (snapshot saved to {}):\n{}'.format(name, path, top))
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        path = os.path.join(PROFILE_DIR, 'vicbot2-{}.prof'.format(name))
+        profiler.dump_stats(path)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(25)
+        logger.info('Profile of {} (saved to {}):\n{}'.format(name, path, output.getvalue()))
+
+    @contextlib.contextmanager
+    def record(self, kind, count=1):
+        '''Count one request or parse of the given kind, or count of them done together, and time it.'''
+        stage = self.current_stage
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                counter = self._stage_stats(stage).setdefault(kind, {'count': 0, 'seconds': 0.0})
+                counter['count'] += count
+                counter['seconds'] += elapsed
+
+    def add(self, key, amount):
+        '''Add to a plain counter of the current stage, such as 'bytes_down'.'''
+        with self.lock:
+            stats = self._stage_stats(self.current_stage)
+            stats[key] = stats.get(key, 0) + amount
+
+    def report(self):
+        '''Human-readable summary, one line per stage.'''
+        lines = []
+        for stage, stats in self.stats.items():
+            parts = ['{:.2f}s'.format(stats['wall_seconds'])]
+            parts.extend('{} {} ({:.2f}s)'.format(counter['count'], kind, counter['seconds'])
+                         for kind, counter in sorted(stats.items()) if isinstance(counter, dict))
+            parts.append('{} bytes down, {} bytes up'.format(stats['bytes_down'], stats['bytes_up']))
+            if 'bytes_saved' in stats:
+                parts.append('{} bytes saved by partial fetches'.format(stats['bytes_saved']))
+            lines.append('{}: {}'.format(stage, ', '.join(parts)))
+        return '\n'.join(lines)
+
+    def write_history(self, path=RUN_HISTORY_PATH, **details):
+        '''
+        Append the run's figures to the history file as a single JSON line.
+
+        details: extra fields describing the run, such as the mode it ran in
+        '''
+        entry = {
+            'run_id': self.run_id,
+            'started': self.started.isoformat(),
+            'seconds': (datetime.datetime.now(datetime.timezone.utc) - self.started).total_seconds(),
+            'stages': self.stats,
+        }
+        entry.update(details)
+        with open(path, 'a') as outfile:
+            outfile.write(json.dumps(entry, sort_keys=True) + '\n')
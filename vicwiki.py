@@ -0,0 +1,506 @@
+'''
+Wiki access for VICBot2.
+
+LiveWiki talks to Commons through pywikibot, LocalWiki is a file-backed
+stand-in for offline runs. Both report every request to a vicstats.Recorder,
+and both can run in dry-run mode, where saves are printed as diffs instead
+of being made.
+'''
+import collections
+import contextlib
+import difflib
+import json
+import re
+import threading
+
+import pywikibot
+from loguru import logger
+
+from vicstats import Recorder
+
+# The API accepts up to 50 titles per query for normal accounts
+BATCH_SIZE = 50
+# Pages held by the run-scoped PageCache before the least recently used ones are dropped
+PAGE_CACHE_SIZE = 200
+# Section headings as MediaWiki splits pages into sections by them
+HEADING_RE = re.compile(r'^(={1,6})[^\n]+?\1[ \t]*$', re.M)
+# Keys of a failed edit response naming the extension which refused the edit -> error code to report, if it gives none
+EDIT_FAILURE_HOOKS = {'captcha': 'captcha', 'spamblacklist': 'spamblacklist', 'abusefilter': 'abusefilter-disallowed'}
+NAMESPACES = {'User': 2, 'User talk': 3, 'Commons': 4, 'File': 6, 'Template': 10, 'Category': 14}
+
+
+def chunks(items, size):
+    '''Split a list into consecutive slices of at most size items.'''
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def namespace_of(title):
+    prefix, _, rest = title.partition(':')
+    return NAMESPACES.get(prefix, 0) if rest else 0
+
+
+def normalize(title):
+    '''Spell a title the way the API reports it.'''
+    return title.replace('_', ' ').strip()
+
+
+def response_size(data):
+    '''Approximate size of an API response on the wire, before compression.'''
+    return len(json.dumps(data, ensure_ascii=False).encode())
+
+
+def new_section(page_text, section_title, text):
+    '''Page text with a new section added at the end, like the API's section=new does.'''
+    return '{}== {} ==\n\n{}'.format(page_text + '\n\n' if page_text else '', section_title, text)
+
+
+def page_section(text, section):
+    '''
+    Text of one section of a page, like the API's rvsection gives it.
+
+    section: 0 for the part before the first heading, n for the nth heading
+        up to the next heading of the same or a higher level
+    Returns '' if the page has no such section.
+    '''
+    headings = list(HEADING_RE.finditer(text))
+    if section == 0:
+        return (text[:headings[0].start()] if headings else text).rstrip('\n')
+    if section > len(headings):
+        return ''
+    heading = headings[section - 1]
+    level = len(heading.group(1))
+    end = next((later.start() for later in headings[section:] if len(later.group(1)) <= level), len(text))
+    return text[heading.start():end].rstrip('\n')
+
+
+def missing_page(title):
+    return {'title': title, 'exists': False, 'text': '', 'revid': None, 'length': 0, 'content_model': 'wikitext',
+            'categories': [], 'templates': []}
+
+
+class PageCache:
+    '''
+    Run-scoped LRU cache of page records and their parse trees, keyed by (title, revid).
+
+    A cached page is trusted for the rest of the run until a newer revid is
+    seen for it or the bot saves it; a stale base revid is still caught by
+    the edit conflict check on save.
+
+    size: number of pages to hold, the least recently used ones are dropped first
+    '''
+
+    def __init__(self, size=PAGE_CACHE_SIZE):
+        self.size = size
+        # title -> {'record': ..., 'tree': parse tree of record['text'] or None}
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, title):
+        '''Cached record of a page, or None.'''
+        with self.lock:
+            entry = self.entries.get(title)
+            if entry is None:
+                return None
+            self.entries.move_to_end(title)
+            return entry['record']
+
+    def put(self, title, record):
+        with self.lock:
+            self.entries[title] = {'record': record, 'tree': None}
+            self.entries.move_to_end(title)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def observe(self, title, revid):
+        '''Drop a page if revid shows it has been edited since it was cached.'''
+        with self.lock:
+            entry = self.entries.get(title)
+            if entry is not None and entry['record']['revid'] != revid:
+                del self.entries[title]
+
+    def invalidate(self, title):
+        with self.lock:
+            self.entries.pop(title, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def tree(self, title, revid, text, parse, take=False):
+        '''
+        Parse tree of a page revision, parsed at most once per run.
+
+        parse: function turning text into a tree, called on a cache miss
+        take: the caller is going to modify the tree, so it is handed over and not kept
+        '''
+        with self.lock:
+            entry = self.entries.get(title)
+            if entry is None or entry['record']['revid'] != revid or entry['record']['text'] != text:
+                entry = None
+            tree = entry and entry['tree']
+            if entry is not None and take:
+                entry['tree'] = None
+        if tree is None:
+            tree = parse(text)
+            if entry is not None and not take:
+                with self.lock:
+                    entry['tree'] = tree
+        return tree
+
+
+class Wiki:
+    '''
+    Common part of the wiki backends: batching, recording and dry runs.
+
+    Backends implement _load_batch, _category_members and _save_page, and
+    optionally _recent_changes.
+    '''
+    # Seconds between two saves, SaveExecutor paces its workers by this
+    edit_interval = 0
+
+    def __init__(self, recorder=None, dry_run=False):
+        self.recorder = recorder or Recorder()
+        self.dry_run = dry_run
+        # Last text seen for each page, only kept in dry runs to print diffs against
+        self.seen_text = {}
+        # Keeps diffs of saves running on different threads apart
+        self.print_lock = threading.Lock()
+        self.cache = PageCache()
+
+    def load_pages(self, titles, content=True, categories=False, templates=None, redirects=False, section=None):
+        '''
+        Load existence, latest revid and optionally text, categories and templates for many pages at once.
+
+        Pages are requested BATCH_SIZE titles at a time, so the number of
+        requests grows with len(titles)/50 instead of with len(titles).
+
+        titles: list of page titles
+        content: also fetch the wikitext of the latest revision
+        categories: also fetch the categories of each page
+        templates: list of template titles, report which of them each page transcludes
+        redirects: follow redirects, the record then describes the final target
+        section: only fetch the text of this section, see page_section
+        Returns a dict mapping each requested title to a dict with the keys
+        'title', 'exists', 'text', 'revid', 'length' (size of the whole page
+        in bytes), 'content_model', 'categories' and 'templates'.
+
+        Plain text loads are served from the run's PageCache when possible,
+        every other load only updates what the cache knows about revids.
+        '''
+        cacheable = content and not categories and not templates and not redirects and section is None
+        pages = {}
+        wanted = []
+        for title in dict.fromkeys(titles):
+            record = self.cache.get(title) if cacheable else None
+            if record is None:
+                wanted.append(title)
+            else:
+                pages[title] = record
+        for batch in chunks(wanted, BATCH_SIZE):
+            with self.recorder.record('read'):
+                loaded = self._load_batch(batch, content, categories, templates, redirects, section)
+            for title in batch:
+                # Titles the backend silently dropped are treated as missing
+                record = pages[title] = loaded.get(title) or missing_page(title)
+                if cacheable:
+                    self.cache.put(title, record)
+                elif not redirects:
+                    self.cache.observe(title, record['revid'])
+        if self.dry_run and content and section is None:
+            for record in pages.values():
+                self.seen_text[record['title']] = record['text']
+        return pages
+
+    def category_members(self, category, namespace=None):
+        '''Titles of all pages in a category, optionally only from one namespace.'''
+        with self.recorder.record('read'):
+            return self._category_members(category, namespace)
+
+    def recent_changes(self, since, namespaces=None):
+        '''
+        Edits and page creations from since (an ISO 8601 timestamp, inclusive) on, oldest first.
+
+        namespaces: list of namespace numbers to limit the changes to
+        Returns a list of dicts with the keys 'rcid', 'title', 'user', 'revid' and 'timestamp'.
+        '''
+        with self.recorder.record('read'):
+            return self._recent_changes(since, namespaces)
+
+    def _recent_changes(self, since, namespaces):
+        raise NotImplementedError('{} has no recent changes feed'.format(type(self).__name__))
+
+    def save_page(self, title, text, summary, minor=True, baserevid=None, create_only=False, section_title=None,
+                  only_if_changed=False):
+        '''
+        Save new text to a page with a single edit request.
+
+        baserevid: revid the new text is based on, lets the backend detect edit conflicts
+        create_only: fail if the page exists, for pages which were missing when they were read
+        section_title: add text as a new section with this heading instead of replacing
+            the page, without the page having to be loaded. baserevid is only informative then.
+        only_if_changed: load the page first, from the run's cache if possible, and
+            don't save if it already has this text
+        Returns False if the save was skipped as a no-op, True otherwise.
+        '''
+        if only_if_changed and section_title is None:
+            current = self.load_pages([title])[title]
+            # MediaWiki drops trailing whitespace on save
+            if current['exists'] and current['text'].rstrip() == str(text).rstrip():
+                logger.debug('{} already has this text, not saving'.format(title))
+                return False
+        if self.dry_run and title not in self.seen_text:
+            self.load_pages([title])
+        self.recorder.add('bytes_up', len(str(text).encode()))
+        self.cache.invalidate(title)
+        with self.recorder.record('write'):
+            if self.dry_run:
+                new_text = str(text)
+                if section_title is not None:
+                    new_text = new_section(self.seen_text.get(title, ''), section_title, text)
+                self.print_diff(title, self.seen_text.get(title, ''), new_text, summary)
+                self.seen_text[title] = new_text
+            else:
+                self._save_page(title, text, summary, minor, baserevid, create_only, section_title)
+        return True
+
+    def print_diff(self, title, old_text, new_text, summary):
+        diff = difflib.unified_diff(old_text.splitlines(), str(new_text).splitlines(),
+                                    'a/{}'.format(title), 'b/{}'.format(title), lineterm='')
+        with self.print_lock:
+            print('--- Planned edit to {} ({})'.format(title, summary))
+            for line in diff:
+                print(line)
+
+    @contextlib.contextmanager
+    def own_write_pacing(self):
+        '''Context in which the caller paces saves itself.'''
+        yield
+
+    def close(self):
+        pass
+
+
+class LiveWiki(Wiki):
+    '''Commons, through the pywikibot API layer.'''
+
+    def __init__(self, recorder=None, dry_run=False):
+        super().__init__(recorder, dry_run)
+        self.site = pywikibot.Site()
+        self.edit_interval = pywikibot.config.put_throttle
+
+    def _load_batch(self, batch, content, categories, templates, redirects, section):
+        props = ['info']
+        params = {}
+        if content:
+            props.append('revisions')
+            params.update(rvprop='ids|content', rvslots='main')
+            if section is not None:
+                params.update(rvsection=section)
+        if categories:
+            props.append('categories')
+            params.update(cllimit='max')
+        if templates:
+            props.append('templates')
+            params.update(tltemplates=templates, tllimit='max')
+        if redirects:
+            params.update(redirects=True)
+        # The API answers with normalized (and maybe redirect target) titles, map them back to what we asked for
+        aliases = {}
+        records = {}
+        continue_params = {}
+        while True:
+            data = self.site.simple_request(action='query', titles=batch, prop='|'.join(props),
+                                            formatversion=2, **params, **continue_params).submit()
+            self.recorder.add('bytes_down', response_size(data))
+            query = data.get('query', {})
+            for alias in query.get('normalized', []) + query.get('redirects', []):
+                aliases[alias['from']] = alias['to']
+            for page in query.get('pages', []):
+                record = records.setdefault(page['title'], {
+                    'title': page['title'],
+                    'exists': 'missing' not in page and 'invalid' not in page,
+                    'text': '',
+                    'revid': page.get('lastrevid'),
+                    'length': page.get('length', 0),
+                    'content_model': page.get('contentmodel', 'wikitext'),
+                    'categories': [],
+                    'templates': [],
+                })
+                # Revisions, categories and templates may each arrive in a different continuation
+                if page.get('revisions'):
+                    revision = page['revisions'][0]
+                    record['revid'] = revision['revid']
+                    record['text'] = revision['slots']['main']['content']
+                record['categories'].extend(cat['title'] for cat in page.get('categories', []))
+                record['templates'].extend(template['title'] for template in page.get('templates', []))
+            if 'continue' not in data:
+                break
+            continue_params = data['continue']
+        pages = {}
+        for title in batch:
+            resolved = title
+            # Bounded, in case of redirect loops
+            for _ in range(len(aliases) + 1):
+                if resolved not in aliases:
+                    break
+                resolved = aliases[resolved]
+            if resolved in records:
+                pages[title] = records[resolved]
+        return pages
+
+    def _category_members(self, category, namespace):
+        members = []
+        params = {'cmnamespace': namespace} if namespace is not None else {}
+        continue_params = {}
+        while True:
+            data = self.site.simple_request(action='query', list='categorymembers', cmtitle=category, cmprop='title',
+                                            cmlimit='max', formatversion=2, **params, **continue_params).submit()
+            self.recorder.add('bytes_down', response_size(data))
+            members.extend(page['title'] for page in data.get('query', {}).get('categorymembers', []))
+            if 'continue' not in data:
+                break
+            continue_params = data['continue']
+        return members
+
+    def _recent_changes(self, since, namespaces):
+        changes = []
+        params = {'rcnamespace': namespaces} if namespaces else {}
+        continue_params = {}
+        while True:
+            data = self.site.simple_request(action='query', list='recentchanges', rcstart=since, rcdir='newer',
+                                            rctype='edit|new', rcprop='ids|title|user|timestamp', rclimit='max',
+                                            formatversion=2, **params, **continue_params).submit()
+            self.recorder.add('bytes_down', response_size(data))
+            changes.extend({'rcid': change['rcid'], 'title': change['title'], 'user': change.get('user', ''),
+                            'revid': change['revid'], 'timestamp': change['timestamp']}
+                           for change in data.get('query', {}).get('recentchanges', []))
+            if 'continue' not in data:
+                break
+            continue_params = data['continue']
+        return changes
+
+    def _save_page(self, title, text, summary, minor, baserevid, create_only, section_title):
+        params = {}
+        if section_title is not None:
+            # New sections never conflict with other edits, the base revid doesn't apply
+            params.update(section='new', sectiontitle=section_title)
+        elif baserevid:
+            params['baserevid'] = baserevid
+        if create_only:
+            params['createonly'] = True
+        data = self.site.simple_request(action='edit', title=title, text=str(text), summary=summary, minor=minor,
+                                        notminor=not minor, bot=True, token=self.site.tokens['csrf'], **params).submit()
+        result = data.get('edit', {})
+        if result.get('result') != 'Success':
+            # Captchas, AbuseFilter and the spam blacklist refuse an edit in the response instead of with an error
+            code = result.get('code') or next((code for hook, code in EDIT_FAILURE_HOOKS.items() if hook in result), 'editfailure')
+            raise pywikibot.exceptions.APIError(code, result.get('info', 'The edit was not saved.'))
+
+    @contextlib.contextmanager
+    def own_write_pacing(self):
+        # pywikibot would otherwise wait put_throttle seconds before every save on top of the caller's pacing
+        throttle = self.site.throttle
+        writedelay = throttle.writedelay
+        throttle.writedelay = 0
+        try:
+            yield
+        finally:
+            throttle.writedelay = writedelay
+
+
+class LocalWiki(Wiki):
+    '''
+    File-backed stand-in for Commons.
+
+    The file is JSON of the form
+        {"pages": {"<title>": {"text": "...", "categories": ["Category:..."],
+                               "templates": ["Template:VI"], "redirect": "<title>",
+                               "page_id": 1, "revid": 1, "protected": false,
+                               "content_model": "wikitext", "maxlag": 0, "ratelimited": 0}}}
+    where everything but "text" is optional. "templates" doubles as the
+    templatelinks table and "categories" as categorylinks for LocalReplica.
+    "maxlag" and "ratelimited" are numbers of save attempts the page answers
+    with that error before a save goes through.
+    Unless running dry, saves are written back to the file on close().
+    '''
+
+    def __init__(self, path, recorder=None, dry_run=False):
+        super().__init__(recorder, dry_run)
+        self.path = path
+        self.lock = threading.Lock()
+        with open(path) as infile:
+            self.pages = {normalize(title): page for title, page in json.load(infile)['pages'].items()}
+        for page_id, (title, page) in enumerate(sorted(self.pages.items()), start=1):
+            page.setdefault('page_id', page_id)
+            page.setdefault('revid', 1)
+
+    def resolve(self, title):
+        '''Follow redirects, including double redirects, from title.'''
+        seen = {title}
+        while title in self.pages and self.pages[title].get('redirect'):
+            title = normalize(self.pages[title]['redirect'])
+            if title in seen:
+                break
+            seen.add(title)
+        return title
+
+    def _load_batch(self, batch, content, categories, templates, redirects, section):
+        pages = {}
+        with self.lock:
+            for title in batch:
+                resolved = self.resolve(normalize(title)) if redirects else normalize(title)
+                page = self.pages.get(resolved)
+                if page is None:
+                    pages[title] = missing_page(resolved)
+                    continue
+                pages[title] = {
+                    'title': resolved,
+                    'exists': True,
+                    'text': page['text'] if content else '',
+                    'revid': page['revid'],
+                    'length': len(page['text'].encode()),
+                    'content_model': page.get('content_model', 'wikitext'),
+                    'categories': list(page.get('categories', [])) if categories else [],
+                    'templates': [template for template in page.get('templates', []) if template in templates] if templates else [],
+                }
+                if content and section is not None:
+                    pages[title]['text'] = page_section(page['text'], section)
+                self.recorder.add('bytes_down', len(pages[title]['text'].encode()))
+        return pages
+
+    def _category_members(self, category, namespace):
+        with self.lock:
+            return [title for title, page in sorted(self.pages.items())
+                    if category in page.get('categories', []) and (namespace is None or namespace_of(title) == namespace)]
+
+    def _save_page(self, title, text, summary, minor, baserevid, create_only, section_title):
+        title = normalize(title)
+        with self.lock:
+            page = self.pages.get(title)
+            if page and create_only:
+                raise pywikibot.exceptions.APIError('articleexists', 'The page you tried to create has been created already.')
+            if page and baserevid and section_title is None and page['revid'] != baserevid:
+                raise pywikibot.exceptions.APIError('editconflict', 'Edit conflict.')
+            for code, info in (('maxlag', 'Waiting for a database server: 6 seconds lagged.'),
+                               ('ratelimited', "You've exceeded your rate limit. Please wait some time and try again.")):
+                if page and page.get(code):
+                    page[code] -= 1
+                    raise pywikibot.exceptions.APIError(code, info)
+            if page and page.get('protected'):
+                raise pywikibot.exceptions.APIError('protectedpage', 'This page has been protected to prevent editing or other actions.')
+            if page and page.get('content_model', 'wikitext') != 'wikitext' and section_title is not None:
+                raise pywikibot.exceptions.APIError('sectionsnotsupported', 'Sections are not supported for this content model.')
+            if page is None:
+                page = self.pages[title] = {'page_id': max((p['page_id'] for p in self.pages.values()), default=0) + 1, 'revid': 0}
+            if section_title is not None:
+                text = new_section(page.get('text', ''), section_title, text)
+            page['text'] = str(text)
+            page['revid'] += 1
+            logger.debug('Saved {} on the local wiki: {}'.format(title, summary))
+
+    def close(self):
+        if self.dry_run:
+            return
+        with open(self.path, 'w') as outfile:
+            json.dump({'pages': self.pages}, outfile, indent=1, sort_keys=True)